@@ -1,10 +1,10 @@
 import os
 from flask import Flask, jsonify, g
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from .exceptions import ValidationError
+from .pool import PooledSQLAlchemy
 
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
 ma = Marshmallow()
 
 
@@ -19,6 +19,26 @@ def create_app(config_name):
     # initialize extensions
     db.init_app(app)
     ma.init_app(app)
+    from .cache import entities, tokens
+    entities.init_app(app)
+    tokens.init_app(app)
+    # registered before compression so that it sees the bytes actually sent
+    from .metrics import metrics
+    metrics.init_app(app)
+    from .compression import compress_response, payloads
+    payloads.init_app(app)
+    app.after_request(compress_response)
+    from .groupcommit import commits
+    commits.init_app(app)
+    from .replicas import remember_writes, replicas
+    replicas.init_app(app)
+    app.after_request(remember_writes)
+    from .imports import importer
+    importer.init_app(app)
+    # each worker process takes over the jobs of the ones that died
+    app.before_first_request(importer.recover)
+    from .snapshots import snapshots
+    snapshots.init_app(app)
 
     # register blueprints
     from .api_v1 import api as api_blueprint
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import categories, items, users, errors
+from . import categories, items, users, changes, export, imports, internal, errors
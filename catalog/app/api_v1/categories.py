@@ -1,17 +1,100 @@
 from flask import jsonify, request
+from sqlalchemy import and_, or_
 from . import api
 from .. import db
+from ..cache import entities
+from ..compression import precompressed
+from ..groupcommit import commits
 from ..auth import auth_token
-from ..models import Category
+from ..exceptions import ValidationError
+from ..models import Category, Item
+from ..pagination import paginate, page
+from ..replicas import read_replica
 from ..schemas import CategorySchema
+from ..serializers import category_serializer, for_request, item_serializer
+from ..snapshots import snapshot
+from ..streaming import stream, wants_stream
+from ..versions import conditional
+
+# categories with their stored item counts instead of their item ids
+counts_serializer = category_serializer.only(['id', 'name', 'item_count'])
+
+def category_items(ids, limit=None):
+    # the items of several categories in one query, at most `limit` each
+    query = Item.query.filter(Item.cat_id.in_(ids))
+    if limit is not None:
+        # the id of each category's last item within the limit, one index
+        # seek per category since MySQL 5.7 and older SQLite have no window
+        # functions; categories with fewer items have none
+        last = db.session.query(Item.id).filter(Item.cat_id == Category.id) \
+            .order_by(Item.id).limit(1).offset(limit - 1).correlate(Category).as_scalar()
+        bounds = db.session.query(Category.id, last).filter(Category.id.in_(ids)).all()
+        query = query.filter(or_(*[Item.cat_id == cat_id if bound is None else
+                                   and_(Item.cat_id == cat_id, Item.id <= bound)
+                                   for cat_id, bound in bounds]))
+    return query.order_by(Item.cat_id, Item.id)
+
+
+def embedded_dump(categories, serializer):
+    # categories with their items nested instead of their item ids
+    limit = request.args.get('items_limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValidationError('Invalid items_limit: ' + limit)
+        if limit < 1:
+            raise ValidationError('Invalid items_limit: must be at least 1')
+    output = serializer.dump_many(categories, collections=False)
+    if 'items' not in serializer.fields:
+        return output
+    items = {}
+    if categories:
+        for item in category_items([category.id for category in categories], limit):
+            items.setdefault(item.cat_id, []).append(item)
+    # the id may not be among the fields asked for
+    for category, data in zip(categories, output):
+        data['items'] = item_serializer.dump_many(items.get(category.id, []))
+    return output
+
+
+def embeds_items():
+    embed = request.args.get('embed')
+    if embed is not None and embed != 'items':
+        raise ValidationError('Invalid embed: only items can be embedded')
+    return embed == 'items'
 
 # Get the urls of all categories
 @api.route('/categories', methods=['GET'])
+@snapshot('categories')
+@read_replica
+@conditional('categories')
+@precompressed
 def get_categories_all():
-    categories = Category.query.all()
-    category_schema = CategorySchema(many=True)
-    output = category_schema.dump(categories).data
-    return jsonify({'categories': output})
+    if request.args.get('with_counts') in ('1', 'true'):
+        serializer = for_request(counts_serializer)
+    else:
+        serializer = for_request(category_serializer)
+    query = Category.query.options(*serializer.options())
+    dump_many = serializer.dump_many
+    if embeds_items():
+        dump_many = lambda categories: embedded_dump(categories, serializer)
+    if wants_stream():
+        return stream(query, Category.id, dump_many)
+    categories, next_url = paginate(query, Category.id, 'api.get_categories_all')
+    return jsonify(page('categories', dump_many(categories), next_url, 'categories', query))
+
+# Get the item counts of all categories
+@api.route('/categories/stats', methods=['GET'])
+@read_replica
+@conditional('categories')
+@precompressed
+def get_categories_stats():
+    serializer = for_request(counts_serializer)
+    categories = Category.query.options(*counts_serializer.options()).order_by(Category.id).all()
+    return jsonify({'categories': [serializer.project(data) for data in
+                                   counts_serializer.dump_many(categories)],
+                    'total': sum(category.item_count for category in categories)})
 
 # Create a new category
 @api.route('/categories', methods=['POST'])
@@ -21,17 +104,20 @@ def new_category():
     category.import_data(request.json)
     category_schema = CategorySchema()
     data = category_schema.dump(category).data
-    db.session.add(category)
-    db.session.commit()
+    commits.add(category)
     data['id'] = category.id
     return jsonify(data), 201
 
 # Get a category
 @api.route('/categories/<int:id>', methods=['GET'])
+@read_replica
+@conditional('category:{id}')
 def get_category(id):
-    category = Category.query.get_or_404(id)
-    category_schema = CategorySchema()
-    return jsonify(category_schema.dump(category).data)
+    serializer = for_request(category_serializer)
+    if embeds_items():
+        category = Category.query.options(*serializer.options()).get_or_404(id)
+        return jsonify(embedded_dump([category], serializer)[0])
+    return jsonify(serializer.project(entities.get_or_404(Category, id, category_serializer)))
 
 # Edit a category
 @api.route('/categories/<int:id>', methods=['PUT'])
@@ -0,0 +1,69 @@
+from flask import jsonify, url_for
+from . import api
+from ..bulk import chunks
+from ..models import Category, Change, Item
+from ..pagination import encode_cursor, page_args
+from ..replicas import read_replica
+from ..serializers import category_serializer, item_serializer
+
+# categories as listed with their counts, without their items
+feed_serializers = {'categories': (Category, category_serializer.only(['id', 'name', 'item_count'])),
+                    'items': (Item, item_serializer)}
+
+
+def current_rows(changes):
+    """Return the serialized rows upserted by `changes` that still exist,
+    keyed by (entity, id)."""
+    rows = {}
+    for entity, (model, serializer) in feed_serializers.items():
+        ids = [change.entity_id for change in changes if change.entity == entity and not change.deleted]
+        for chunk in chunks(ids):
+            objs = model.query.options(*serializer.options()).filter(model.id.in_(chunk)).all()
+            rows.update(((entity, obj.id), data) for obj, data in zip(objs, serializer.dump_many(objs)))
+    return rows
+
+
+def collapse(changes):
+    """Keep one change per row: rows that still exist are upserted where
+    they first changed, so categories stay ahead of their items, and
+    deleted rows are deleted where they last changed."""
+    last = dict(((change.entity, change.entity_id), change) for change in changes)
+    seen = set()
+    collapsed = []
+    for change in changes:
+        key = (change.entity, change.entity_id)
+        if last[key].deleted:
+            if change is last[key]:
+                collapsed.append(change)
+        elif key not in seen:
+            seen.add(key)
+            collapsed.append(last[key])
+    return collapsed
+
+# Get the changes to items and categories after a cursor, oldest first
+@api.route('/changes', methods=['GET'])
+@read_replica
+def get_changes():
+    limit, since = page_args('since')
+    query = Change.query
+    if since is not None:
+        query = query.filter(Change.id > since)
+    changes = query.order_by(Change.id).limit(limit + 1).all()
+    next_url = None
+    if len(changes) > limit:
+        changes = changes[:limit]
+        next_url = url_for('api.get_changes', since=encode_cursor(changes[-1].id), limit=limit,
+                           _external=True)
+    cursor = encode_cursor(changes[-1].id if changes else since or 0)
+    changes = collapse(changes)
+    rows = current_rows(changes)
+    entries = []
+    for change in changes:
+        key = (change.entity, change.entity_id)
+        if change.deleted:
+            entries.append({'type': 'delete', 'entity': change.entity, 'id': change.entity_id})
+        elif key in rows:
+            entries.append({'type': 'upsert', 'entity': change.entity, 'id': change.entity_id,
+                            'data': rows[key]})
+        # otherwise the row was deleted by a later change, on a later page
+    return jsonify({'changes': entries, 'cursor': cursor, 'next': next_url})
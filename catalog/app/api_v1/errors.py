@@ -25,6 +25,13 @@ def method_not_supported(e):
     response.status_code = 405
     return response
 
+@api.app_errorhandler(503)  # this has to be an app-wide handler
+def service_unavailable(e):
+    response = jsonify({'status': 503, 'error': 'service unavailable',
+                        'message': 'the request timed out, please retry'})
+    response.status_code = 503
+    return response
+
 @api.app_errorhandler(500)  # this has to be an app-wide handler
 def internal_server_error(e):
     response = jsonify({'status': 500, 'error': 'internal server error',
@@ -0,0 +1,19 @@
+from flask import Response, request, stream_with_context
+from . import api
+from ..exceptions import ValidationError
+from ..export import FORMATS, export, parse_after, parse_entities
+
+# Export every category and item as NDJSON or CSV
+@api.route('/export', methods=['GET'])
+def export_catalog():
+    format = request.args.get('format', 'ndjson')
+    if format not in FORMATS:
+        raise ValidationError('Invalid format: expected ndjson or csv')
+    entities = parse_entities(request.args.get('entity'))
+    after = parse_after(request.args.get('after'))
+    gzip = request.args.get('gzip') in ('1', 'true')
+    filename = 'catalog.' + format + ('.gz' if gzip else '')
+    response = Response(stream_with_context(export(format, entities, after, gzip)),
+                        mimetype='application/gzip' if gzip else FORMATS[format])
+    response.headers['Content-Disposition'] = 'attachment; filename=' + filename
+    return response
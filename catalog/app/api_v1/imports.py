@@ -0,0 +1,22 @@
+from flask import jsonify, request, url_for
+from . import api
+from ..auth import auth_token
+from ..exceptions import ValidationError
+from ..imports import FORMATS, importer, status
+from ..models import ImportJob
+
+# Upload a NDJSON or CSV file of items and categories to import in the background
+@api.route('/imports', methods=['POST'])
+@auth_token.login_required
+def new_import():
+    format = request.args.get('format') or FORMATS.get(request.mimetype)
+    if format not in FORMATS.values():
+        raise ValidationError('Invalid format: expected ndjson or csv')
+    job = importer.submit(request.stream, format)
+    return jsonify(status(job)), 202, {'Location': url_for('api.get_import', id=job.id, _external=True)}
+
+# Get the progress of an import
+@api.route('/imports/<int:id>', methods=['GET'])
+@auth_token.login_required
+def get_import(id):
+    return jsonify(status(ImportJob.query.get_or_404(id)))
@@ -0,0 +1,16 @@
+from flask import jsonify
+from . import api
+from .. import db
+from ..cache import entities
+from ..pool import stats
+
+
+# Get the entity cache counters
+@api.route('/_internal/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(entities.stats())
+
+# Get the connection pool counters and checkout timings
+@api.route('/_internal/pool', methods=['GET'])
+def get_pool_stats():
+    return jsonify(stats.report(db.engine.pool))
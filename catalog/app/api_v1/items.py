@@ -1,33 +1,88 @@
-from flask import jsonify, request
+from flask import current_app, jsonify, request, url_for
+from sqlalchemy.exc import IntegrityError
 from . import api
 from .. import db
+from ..bulk import delete_items, existing_titles, insert_items, item_criteria, prepare_items, update_items
+from ..cache import entities
+from ..compression import precompressed
+from ..groupcommit import commits
 from ..auth import auth_token
-from ..models import Category, Item
-from ..schemas import CategorySchema, ItemSchema
+from ..exceptions import ValidationError
+from ..models import Category, Item, integer_types, string_types
+from ..pagination import paginate, page, page_args
+from ..replicas import read_replica
+from ..schemas import ItemSchema
+from ..search import search
+from ..serializers import for_request, item_serializer
+from ..snapshots import snapshot
+from ..streaming import stream, wants_stream
+from ..versions import conditional
 
 
 # Get all items in a specific category
 @api.route('/categories/<int:id>/items', methods=['GET'])
+@read_replica
+@conditional('category:{id}')
+@precompressed
 def get_category_items(id):
     category = Category.query.get_or_404(id)
-    category_schema = CategorySchema()
-    items = Item.query.filter_by(cat_id=id).all()
-    item_schema = ItemSchema(many=True)
-    return jsonify({category.name + ' items': item_schema.dump(items).data})
+    serializer = for_request(item_serializer)
+    query = Item.query.filter_by(cat_id=id).options(*serializer.options())
+    if wants_stream():
+        return stream(query, Item.id, serializer.dump_many)
+    items, next_url = paginate(query, Item.id, 'api.get_category_items', id=id)
+    return jsonify(page(category.name + ' items', serializer.dump_many(items), next_url,
+                        'category:' + str(id), query))
 
 # Get all items
 @api.route('/items', methods=['GET'])
+@snapshot('items')
+@read_replica
+@conditional('items')
+@precompressed
 def get_items_all():
-    items = Item.query.all()
-    item_schema = ItemSchema(many=True)
-    return jsonify({'items': item_schema.dump(items).data})
+    serializer = for_request(item_serializer)
+    query = Item.query.options(*serializer.options())
+    if wants_stream():
+        return stream(query, Item.id, serializer.dump_many)
+    items, next_url = paginate(query, Item.id, 'api.get_items_all')
+    return jsonify(page('items', serializer.dump_many(items), next_url, 'items', query))
+
+# Search items by title and description, best matches first
+@api.route('/items/search', methods=['GET'])
+@read_replica
+@conditional('items')
+@precompressed
+def search_items():
+    query = request.args.get('q', '').strip()
+    if not query:
+        raise ValidationError('Invalid search: missing q')
+    limit, after = page_args()
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        raise ValidationError('Invalid offset: ' + request.args['offset'])
+    if offset < 0:
+        raise ValidationError('Invalid offset: must not be negative')
+    ids = search(query, limit + 1, offset)
+    next_url = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        args = request.args.to_dict()
+        args.update(offset=offset + limit, limit=limit)
+        next_url = url_for('api.search_items', _external=True, **args)
+    serializer = for_request(item_serializer)
+    found = dict((item.id, item) for item in Item.query.options(*serializer.options())
+                 .filter(Item.id.in_(ids))) if ids else {}
+    items = [found[id] for id in ids if id in found]
+    return jsonify({'items': serializer.dump_many(items), 'next': next_url})
 
 # Get an item
 @api.route('/items/<int:id>', methods=['GET'])
+@read_replica
+@conditional('items')
 def get_item(id):
-    item = Item.query.get_or_404(id)
-    item_schema = ItemSchema()
-    return jsonify(item_schema.dump(item).data)
+    return jsonify(for_request(item_serializer).project(entities.get_or_404(Item, id, item_serializer)))
 
 
 # Create a new item
@@ -40,11 +95,40 @@ def new_item(id):
     item.import_data(data)
     item_schema = ItemSchema()
     item_data = item_schema.dump(item).data
-    db.session.add(item)
-    db.session.commit()
+    commits.add(item)
     item_data['id'] = item.id
     return jsonify(item_data), 201
 
+# Create many items in a category in one transaction
+@api.route('/categories/<int:id>/items/batch', methods=['POST'])
+@auth_token.login_required
+def new_items_batch(id):
+    Category.query.get_or_404(id)
+    entries = request.json
+    if not isinstance(entries, list):
+        raise ValidationError('Invalid items: expected a list')
+    maximum = current_app.config.get('CATALOG_BULK_LIMIT', 10000)
+    if len(entries) > maximum:
+        raise ValidationError('Invalid items: at most ' + str(maximum) + ' per request')
+    results, rows = prepare_items(entries, id)
+    if rows:
+        try:
+            ids = insert_items([row for index, row in rows])
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if not existing_titles([row['title'] for index, row in rows]):
+                raise
+            # another request took one of the titles since they were checked
+            response = jsonify({'status': 409, 'error': 'conflict',
+                                'message': 'a title was taken concurrently, please retry'})
+            response.status_code = 409
+            return response
+        for (index, row), item_id in zip(rows, ids):
+            results[index] = {'id': item_id, 'title': row['title'],
+                              'description': row['description'], 'category': row['cat_id']}
+    return jsonify({'items': results}), 201 if rows else 400
+
 # Edit an item
 @api.route('/items/<int:id>', methods=['PUT'])
 @auth_token.login_required
@@ -72,3 +156,54 @@ def delete_item(id):
     db.session.delete(item)
     db.session.commit()
     return jsonify({}), 204
+
+
+def bulk_criteria():
+    # the filter of a bulk request, from its category and ids arguments
+    category = request.args.get('category')
+    ids = request.args.get('ids')
+    if category is None and ids is None:
+        raise ValidationError('Invalid filter: category or ids is required')
+    try:
+        if category is not None:
+            category = int(category)
+        if ids is not None:
+            ids = [int(id) for id in ids.split(',')]
+    except ValueError:
+        raise ValidationError('Invalid filter: ids must be integers')
+    return item_criteria(category, ids)
+
+# Edit every item matching a filter
+@api.route('/items', methods=['PUT'])
+@auth_token.login_required
+def edit_items():
+    criteria = bulk_criteria()
+    data = request.json
+    if not isinstance(data, dict) or not data:
+        raise ValidationError('Invalid items: nothing to change')
+    values = {}
+    for key in data:
+        if key == 'category':
+            # with the rules of Item.import_data
+            if isinstance(data[key], bool) or not isinstance(data[key], integer_types):
+                raise ValidationError('Invalid items: category must be an id')
+            if Category.query.get(data[key]) is None:
+                raise ValidationError('Invalid items: no category ' + str(data[key]))
+            values['cat_id'] = data[key]
+        elif key == 'description':
+            if data[key] is not None and not isinstance(data[key], string_types):
+                raise ValidationError('Invalid items: description must be a string')
+            values['description'] = data[key]
+        else:
+            raise ValidationError('Invalid items: cannot change ' + key + ' in bulk')
+    count = update_items(criteria, values)
+    db.session.commit()
+    return jsonify({'count': count})
+
+# Delete every item matching a filter
+@api.route('/items', methods=['DELETE'])
+@auth_token.login_required
+def delete_items_matching():
+    count = delete_items(bulk_criteria())
+    db.session.commit()
+    return jsonify({'count': count})
@@ -1,24 +1,29 @@
-from flask import jsonify, request
+from flask import current_app, jsonify, request
+from sqlalchemy.exc import IntegrityError
 from . import api
 from .. import db
+from ..cache import entities
 from ..auth import auth
-from ..models import User
+from ..hashing import hash_passwords
+from ..models import User, string_types
+from ..replicas import read_replica
 from ..schemas import UserSchema
+from ..serializers import for_request, user_serializer
 from ..exceptions import ValidationError
 
 # Get all users
 @api.route('/users', methods=['GET'])
+@read_replica
 def get_users_all():
-    users = User.query.all()
-    users_schema = UserSchema(many=True)
-    return jsonify({'users': users_schema.dump(users).data})
+    serializer = for_request(user_serializer)
+    users = User.query.options(*serializer.options()).all()
+    return jsonify({'users': serializer.dump_many(users)})
 
 # Get a specific users
 @api.route('/users/<int:id>', methods=['GET'])
+@read_replica
 def get_user(id):
-    user = User.query.get_or_404(id)
-    user_schema = UserSchema()
-    return jsonify(user_schema.dump(user).data)
+    return jsonify(for_request(user_serializer).project(entities.get_or_404(User, id, user_serializer)))
 
 
 # Create a new user
@@ -37,6 +42,71 @@ def create_user():
     data['id'] = user.id
     return jsonify({'id': user.id, 'token': user.generate_auth_token()}), 201
 
+# Create many users in one transaction
+@api.route('/users/bulk', methods=['POST'])
+@auth.login_required
+def create_users_bulk():
+    if auth.username() != 'Admin':
+        response = jsonify({'status': 401, 'error': 'unauthorized', 'message': 'please authenticate'})
+        response.status_code = 401
+        return response
+    rows = request.json
+    if not isinstance(rows, list):
+        raise ValidationError('Invalid users: expected a list')
+    maximum = current_app.config.get('CATALOG_BULK_LIMIT', 10000)
+    if len(rows) > maximum:
+        raise ValidationError('Invalid users: at most ' + str(maximum) + ' per request')
+
+    # validate every row before doing any hashing
+    results = [None] * len(rows)
+    accepted = []
+    for index, row in enumerate(rows):
+        if not isinstance(row, dict):
+            results[index] = {'error': 'Invalid user: expected an object'}
+            continue
+        try:
+            username, password = row['username'], row['password']
+        except KeyError as e:
+            results[index] = {'error': 'Invalid user: missing ' + e.args[0]}
+            continue
+        if not isinstance(username, string_types) or not username:
+            results[index] = {'error': 'Invalid user: username must be a non-empty string'}
+        elif not isinstance(password, string_types):
+            results[index] = {'error': 'Invalid user: password must be a string'}
+        else:
+            accepted.append((index, username, password))
+    names = [username for index, username, password in accepted]
+    taken = set()
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        taken.update(username for (username,) in
+                     db.session.query(User.username).filter(User.username.in_(chunk)))
+    creating = []
+    for index, username, password in accepted:
+        if username in taken:
+            results[index] = {'error': 'Invalid user: username ' + username + ' is taken'}
+        else:
+            taken.add(username)
+            creating.append((index, username, password))
+
+    hashes = hash_passwords([password for index, username, password in creating])
+    users = []
+    for (index, username, password), password_hash in zip(creating, hashes):
+        users.append((index, User(username=username, password_hash=password_hash)))
+    db.session.add_all([user for index, user in users])
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request took one of the usernames since they were checked
+        db.session.rollback()
+        response = jsonify({'status': 409, 'error': 'conflict',
+                            'message': 'a username was taken concurrently, please retry'})
+        response.status_code = 409
+        return response
+    for index, user in users:
+        results[index] = {'id': user.id, 'token': user.generate_auth_token()}
+    return jsonify({'users': results}), 201 if users else 400
+
 # Edit a user
 @api.route('/users/<int:id>', methods=['PUT'])
 @auth.login_required
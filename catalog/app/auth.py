@@ -1,5 +1,9 @@
+import time
 from flask import jsonify, g, current_app
 from flask.ext.httpauth import HTTPBasicAuth
+from sqlalchemy.orm import make_transient_to_detached
+from . import db
+from .cache import MISSING, tokens
 from .models import User
 
 auth = HTTPBasicAuth()
@@ -26,10 +30,30 @@ def verify_auth_token(token, unused):
     if current_app.config.get('IGNORE_AUTH') is True:
         g.user = User.query.get(1)
     else:
-        g.user = User.verify_auth_token(token)
+        g.user = load_token_user(token)
     return g.user is not None
 
 
+def load_token_user(token):
+    # resolve a token to its user, remembering the user for at most
+    # CATALOG_TOKEN_CACHE_TTL seconds and never past the token's expiry
+    state = tokens.get(token)
+    if state is not MISSING:
+        user = User(**state)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+    generation = tokens.token()
+    data = User.read_auth_token(token)
+    if data is None:
+        return None
+    user = User.query.get(data['id'])
+    if user is not None:
+        state = dict((c.key, getattr(user, c.key)) for c in User.__table__.columns)
+        tokens.set(token, state, ttl=min(data['exp'] - time.time(), tokens.ttl),
+                   token=generation)
+    return user
+
+
 @auth_token.error_handler
 def unauthorized_token():
     response = jsonify({'status': 401, 'error': 'unauthorized', 'message': 'please authenticate'})
@@ -0,0 +1,135 @@
+from . import db
+from .cache import invalidate_pending
+from .changes import log
+from .counts import adjust
+from .exceptions import ValidationError
+from .models import Item
+from .search import reindex
+from .versions import bump
+
+# how many values go into one IN (...)
+CHUNK_SIZE = 500
+
+
+def chunks(values):
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def existing_titles(titles):
+    taken = set()
+    for chunk in chunks(list(titles)):
+        taken.update(title for (title,) in
+                     db.session.query(Item.title).filter(Item.title.in_(chunk)))
+    return taken
+
+
+def prepare_items(entries, cat_id=None):
+    """Validate item entries with the rules of Item.import_data.
+
+    Returns a list holding an error for each rejected entry and None for
+    the others, and the (index, row) pairs ready to insert. Titles that
+    repeat within `entries` or already exist are rejected as conflicts."""
+    results = [None] * len(entries)
+    prepared = []
+    for index, data in enumerate(entries):
+        if not isinstance(data, dict):
+            results[index] = {'error': 'Invalid item: expected an object'}
+            continue
+        data = dict(data)
+        if cat_id is not None:
+            data['category'] = cat_id
+        try:
+            item = Item().import_data(data)
+        except ValidationError as e:
+            results[index] = {'error': e.args[0]}
+            continue
+        prepared.append((index, {'cat_id': item.cat_id, 'title': item.title,
+                                 'description': item.description}))
+    taken = existing_titles(set(row['title'] for index, row in prepared))
+    rows = []
+    for index, row in prepared:
+        if row['title'] in taken:
+            results[index] = {'error': 'Conflict: an item titled ' + row['title'] + ' already exists'}
+        else:
+            taken.add(row['title'])
+            rows.append((index, row))
+    return results, rows
+
+
+def insert_items(rows):
+    """Insert item rows with a single executemany in the current
+    transaction and return their ids in the same order."""
+    db.session.execute(Item.__table__.insert(), rows)
+    ids = {}
+    for chunk in chunks([row['title'] for row in rows]):
+        ids.update(db.session.query(Item.title, Item.id).filter(Item.title.in_(chunk)))
+    item_ids = [ids[row['title']] for row in rows]
+    deltas = {}
+    for row in rows:
+        deltas[row['cat_id']] = deltas.get(row['cat_id'], 0) + 1
+    items_written(set(deltas), item_ids, deltas)
+    return item_ids
+
+
+def items_written(cat_ids, item_ids, deltas=None, deleted=False):
+    # Core statements bypass the flush listeners, so do their bookkeeping
+    if deltas:
+        adjust(deltas)
+    bump(['items', 'categories'] + ['category:' + str(id) for id in cat_ids])
+    counted = [('categories', id) for id in sorted(deltas or {}) if deltas[id]]
+    if deleted:
+        log(counted, [('items', id) for id in item_ids])
+    else:
+        log(counted + [('items', id) for id in item_ids])
+    invalidate_pending([('items', id) for id in item_ids] +
+                       [('categories', id) for id in cat_ids])
+    reindex(item_ids)
+
+
+def item_criteria(category=None, ids=None):
+    criteria = []
+    if category is not None:
+        criteria.append(Item.cat_id == category)
+    if ids is not None:
+        criteria.append(Item.id.in_(ids))
+    return criteria
+
+
+def affected_items(criteria):
+    # lock the matching rows so the statement that follows hits the same set
+    return db.session.query(Item.id, Item.cat_id).filter(*criteria).with_for_update().all()
+
+
+def update_items(criteria, values):
+    """Apply `values` (column -> value) to every item matching `criteria`
+    with a single UPDATE and return the number of rows changed."""
+    rows = affected_items(criteria)
+    if not rows:
+        return 0
+    count = db.session.query(Item).filter(*criteria).update(values, synchronize_session=False)
+    cat_ids = set(cat_id for id, cat_id in rows)
+    deltas = {}
+    if 'cat_id' in values:
+        target = values['cat_id']
+        cat_ids.add(target)
+        for id, cat_id in rows:
+            if cat_id != target:
+                deltas[cat_id] = deltas.get(cat_id, 0) - 1
+                deltas[target] = deltas.get(target, 0) + 1
+    items_written(cat_ids, [id for id, cat_id in rows], deltas)
+    return count
+
+
+def delete_items(criteria):
+    """Delete every item matching `criteria` with a single DELETE and
+    return the number of rows removed."""
+    rows = affected_items(criteria)
+    if not rows:
+        return 0
+    count = db.session.query(Item).filter(*criteria).delete(synchronize_session=False)
+    deltas = {}
+    for id, cat_id in rows:
+        deltas[cat_id] = deltas.get(cat_id, 0) - 1
+    items_written(set(deltas), [id for id, cat_id in rows], deltas, deleted=True)
+    return count
@@ -0,0 +1,181 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import abort, g
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from . import db
+from .models import Category, Item, User
+from .versions import current_versions
+
+MISSING = object()
+NOT_FOUND = object()
+# the version each cached table is checked against, see versions.py
+VERSION_KEYS = {'items': 'items', 'categories': 'category:{id}', 'users': 'users'}
+
+
+class LRUCache(object):
+    """A thread-safe least-recently-used cache whose entries also expire
+    after a time to live."""
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return default
+            self.data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, token=None):
+        """Store `value` unless something was invalidated since `token`
+        was taken, in which case `value` may already be stale."""
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            if token is not None and token != self.invalidations:
+                return
+            self.data.pop(key, None)
+            self.data[key] = (expires, value)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def token(self):
+        return self.invalidations
+
+    def delete(self, *keys):
+        with self.lock:
+            self.invalidations += 1
+            for key in keys:
+                self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += 1
+            self.data.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data), 'maxsize': self.maxsize, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+class EntityCache(LRUCache):
+    """Serialized items, categories and users keyed by table and id."""
+
+    negative_ttl = 5
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('CATALOG_CACHE_SIZE', 10000)
+        self.ttl = app.config.get('CATALOG_CACHE_TTL', 60)
+        self.negative_ttl = app.config.get('CATALOG_CACHE_NEGATIVE_TTL', 5)
+        self.clear()
+
+    def get_or_404(self, model, id, serializer):
+        """Return the serialized `model` row `id`, reading through the
+        cache. Missing rows are remembered for a shorter time. Entries are
+        only used while the version of their table is the one they were
+        read at, so that writes made by other processes are seen too.
+        Reads from a replica bypass the cache, which a lagging replica
+        would otherwise fill with rows older than their version."""
+        if g.get('replica') is not None:
+            obj = model.query.get(id)
+            if obj is None:
+                abort(404)
+            return serializer.dump(obj)
+        key = (model.__tablename__, id)
+        version_key = VERSION_KEYS[model.__tablename__].format(id=id)
+        version = current_versions([version_key])[version_key][0]
+        entry = self.get(key)
+        if entry is MISSING or entry[0] != version:
+            token = self.token()
+            obj = model.query.get(id)
+            entry = (version, NOT_FOUND if obj is None else serializer.dump(obj))
+            self.set(key, entry, ttl=self.negative_ttl if obj is None else None, token=token)
+        data = entry[1]
+        if data is NOT_FOUND:
+            abort(404)
+        return data
+
+
+class TokenCache(LRUCache):
+    """Users resolved from auth tokens, keyed by token."""
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('CATALOG_TOKEN_CACHE_SIZE', 10000)
+        # other processes do not tell us about the users they change
+        self.ttl = app.config.get('CATALOG_TOKEN_CACHE_TTL', 60)
+        self.clear()
+
+    def forget_users(self, ids):
+        with self.lock:
+            self.invalidations += 1
+            stale = [key for key, (expires, state) in self.data.items() if state['id'] in ids]
+            for key in stale:
+                del self.data[key]
+
+
+entities = EntityCache()
+tokens = TokenCache()
+
+
+def changed_entities(session):
+    """Collect the cache keys of the objects pending in a flush."""
+    keys = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Item):
+            keys.add(('items', obj.id))
+            # a category's representation lists the ids of its items
+            keys.add(('categories', obj.cat_id))
+            keys.update(('categories', id) for id in get_history(obj, 'cat_id').deleted)
+        elif isinstance(obj, (Category, User)):
+            keys.add((obj.__tablename__, obj.id))
+    return keys
+
+
+def invalidate(keys):
+    entities.delete(*keys)
+    users = set(id for table, id in keys if table == 'users')
+    if users:
+        tokens.forget_users(users)
+
+
+def invalidate_pending(keys, session=None):
+    """Invalidate keys written in the session's transaction now, and
+    again once it commits."""
+    session = session or db.session()
+    invalidate(keys)
+    session.info.setdefault('cache_keys', set()).update(keys)
+
+
+@event.listens_for(Session, 'after_flush')
+def invalidate_flushed(session, flush_context):
+    keys = changed_entities(session)
+    if keys:
+        invalidate_pending(keys, session)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    # readers may have cached the old rows again between flush and commit
+    keys = session.info.pop('cache_keys', None)
+    if keys:
+        invalidate(keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop('cache_keys', None)
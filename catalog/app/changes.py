@@ -0,0 +1,67 @@
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import db
+from .counts import flushed_deltas
+from .models import Category, Change, Item
+from .versions import bump
+
+
+def log(upserts=(), deletes=(), session=None):
+    """Queue changes for the feed, to be appended when the current
+    transaction commits. `upserts` and `deletes` are (entity, id) pairs,
+    entity being a table name; they are logged in the order given,
+    upserts first."""
+    session = session or db.session()
+    now = datetime.utcnow()
+    rows = [{'entity': entity, 'entity_id': id, 'deleted': False, 'created': now}
+            for entity, id in upserts] + \
+           [{'entity': entity, 'entity_id': id, 'deleted': True, 'created': now}
+            for entity, id in deletes]
+    if rows:
+        session.info.setdefault('changes', []).extend(rows)
+
+
+def flushed_changes(session):
+    """Return the upserts and deletes of a flush. Categories come before
+    their items when written and after them when deleted, and categories
+    whose item count moved count as written."""
+    categories = set(cat_id for cat_id, delta in flushed_deltas(session).items() if delta)
+    items = []
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Category) and (obj in session.new or session.is_modified(obj)):
+            categories.add(obj.id)
+        elif isinstance(obj, Item) and (obj in session.new or session.is_modified(obj)):
+            items.append(obj.id)
+    deleted = [obj for obj in session.deleted if isinstance(obj, (Item, Category))]
+    deleted_categories = set(obj.id for obj in deleted if isinstance(obj, Category))
+    upserts = [('categories', id) for id in sorted(categories - deleted_categories)] + \
+              [('items', id) for id in sorted(items)]
+    deletes = [('items', obj.id) for obj in deleted if isinstance(obj, Item)] + \
+              [('categories', id) for id in sorted(deleted_categories)]
+    return upserts, deletes
+
+
+@event.listens_for(Session, 'after_flush')
+def log_flushed(session, flush_context):
+    upserts, deletes = flushed_changes(session)
+    log(upserts, deletes, session)
+
+
+@event.listens_for(Session, 'before_commit')
+def append_changes(session):
+    # everything the transaction writes is flushed first, so that it logs
+    # nothing more and takes no other version lock after this one
+    session.flush()
+    rows = session.info.pop('changes', None)
+    if rows:
+        # every writer locks the same version row before its change ids are
+        # handed out and keeps it until it commits, so that ids commit in
+        # order and a poller never skips a change committed late
+        bump(['changes'], session)
+        session.execute(Change.__table__.insert(), rows)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop('changes', None)
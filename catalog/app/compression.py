@@ -0,0 +1,86 @@
+import gzip
+from functools import wraps
+from io import BytesIO
+from flask import current_app, g, request
+from .cache import LRUCache, MISSING
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def choose_encoding():
+    """Return the best content coding the client accepts, or None."""
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(encodings, key=lambda encoding: request.accept_encodings[encoding])
+    return best if request.accept_encodings[best] > 0 else None
+
+
+def compress(data, encoding):
+    level = current_app.config.get('CATALOG_COMPRESS_LEVEL', 6)
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def encode_response(response, encoding):
+    """Compress a buffered response in place if it is worth it. Returns
+    True if the body was replaced."""
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers:
+        return False
+    data = response.get_data()
+    if len(data) < current_app.config.get('CATALOG_COMPRESS_MIN_SIZE', 1024):
+        return False
+    response.vary.add('Accept-Encoding')
+    if encoding is None:
+        return False
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return True
+
+
+def compress_response(response):
+    """after_request hook compressing every sufficiently large response."""
+    if current_app.config.get('CATALOG_COMPRESS', True):
+        encode_response(response, choose_encoding())
+    return response
+
+
+class PayloadCache(LRUCache):
+    """Finished list responses keyed by ETag and content coding. The ETag
+    covers the data versions and the request, so an entry can be served
+    as is until one of its versions is bumped."""
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('CATALOG_PAYLOAD_CACHE_SIZE', 256)
+        self.ttl = app.config.get('CATALOG_PAYLOAD_CACHE_TTL', 300)
+        self.clear()
+
+
+payloads = PayloadCache()
+
+
+def precompressed(f):
+    """Serve a view from the payload cache. Must be applied below
+    `conditional`, which provides the ETag."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        encoding = choose_encoding()
+        key = (g.etag, encoding)
+        entry = payloads.get(key)
+        if entry is not MISSING:
+            data, headers = entry
+            return current_app.response_class(data, headers=headers)
+        rv = current_app.make_response(f(*args, **kwargs))
+        if rv.status_code != 200 or rv.is_streamed:
+            return rv
+        if current_app.config.get('CATALOG_COMPRESS', True):
+            encode_response(rv, encoding)
+        payloads.set(key, (rv.get_data(), list(rv.headers)))
+        return rv
+    return wrapped
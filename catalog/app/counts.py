@@ -0,0 +1,52 @@
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from . import db
+from .models import Category, Item
+
+
+def adjust(deltas, session=None):
+    """Add deltas (category id -> change in items) to the stored item
+    counts within the current transaction."""
+    session = session or db.session()
+    table = Category.__table__
+    for cat_id in sorted(deltas):
+        if deltas[cat_id]:
+            session.execute(table.update().where(table.c.id == cat_id)
+                            .values(item_count=table.c.item_count + deltas[cat_id]))
+
+
+def recount():
+    """Recompute every stored item count from the items table, e.g. for a
+    database created before the counts existed."""
+    categories = Category.__table__
+    items = Item.__table__
+    count = select([func.count(items.c.id)]).where(items.c.cat_id == categories.c.id)
+    db.session.execute(categories.update().values(item_count=count.as_scalar()))
+    db.session.commit()
+
+
+def flushed_deltas(session):
+    deltas = {}
+    for obj in session.new:
+        if isinstance(obj, Item):
+            deltas[obj.cat_id] = deltas.get(obj.cat_id, 0) + 1
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            history = get_history(obj, 'cat_id')
+            cat_id = history.deleted[0] if history.deleted else obj.cat_id
+            deltas[cat_id] = deltas.get(cat_id, 0) - 1
+    for obj in session.dirty:
+        if isinstance(obj, Item):
+            history = get_history(obj, 'cat_id')
+            if history.deleted and history.added:
+                deltas[history.deleted[0]] = deltas.get(history.deleted[0], 0) - 1
+                deltas[history.added[0]] = deltas.get(history.added[0], 0) + 1
+    return deltas
+
+
+@event.listens_for(Session, 'after_flush')
+def count_flushed(session, flush_context):
+    deltas = flushed_deltas(session)
+    if deltas:
+        adjust(deltas, session)
@@ -0,0 +1,101 @@
+import csv
+import json
+import zlib
+from io import BytesIO
+from flask import current_app
+from . import db
+from .exceptions import ValidationError
+from .models import Category, Item
+from .streaming import NDJSON, iter_batches
+
+# exported tables, in export order, with their columns as named in the API
+ENTITIES = ('categories', 'items')
+COLUMNS = {'categories': (('id', Category.id), ('name', Category.name),
+                          ('item_count', Category.item_count)),
+           'items': (('id', Item.id), ('category', Item.cat_id), ('title', Item.title),
+                     ('description', Item.description))}
+# one CSV header for both tables; cells that do not apply stay empty
+CSV_HEADER = ('entity', 'id', 'name', 'item_count', 'category', 'title', 'description')
+FORMATS = {'ndjson': NDJSON, 'csv': 'text/csv'}
+
+
+def parse_entities(value):
+    entities = [entity for entity in (value or ','.join(ENTITIES)).split(',') if entity]
+    for entity in entities:
+        if entity not in ENTITIES:
+            raise ValidationError('Invalid entity: ' + entity)
+    return [entity for entity in ENTITIES if entity in entities]
+
+
+def parse_after(value):
+    """Parse a resume position, '<entity>:<id>' of the last row received."""
+    if value is None:
+        return None
+    entity, _, id = value.partition(':')
+    if entity not in ENTITIES or not id.isdigit():
+        raise ValidationError('Invalid after: expected <entity>:<id>, e.g. items:42')
+    return entity, int(id)
+
+
+def iter_rows(entities, after=None):
+    """Yield (entity, rows) for every row of `entities`, a batch at a time
+    in primary key order, starting after the (entity, id) position."""
+    for entity in entities:
+        start = None
+        if after is not None:
+            if ENTITIES.index(entity) < ENTITIES.index(after[0]):
+                continue
+            if entity == after[0]:
+                start = after[1]
+        names = [name for name, column in COLUMNS[entity]]
+        query = db.session.query(*[column.label(name) for name, column in COLUMNS[entity]])
+        for rows in iter_batches(query, COLUMNS[entity][0][1], start):
+            yield entity, [dict(zip(names, row)) for row in rows]
+
+
+def encode_ndjson(entity, rows):
+    return ''.join(json.dumps(dict(row, entity=entity), sort_keys=True) + '\n'
+                   for row in rows).encode('utf-8')
+
+
+def encode_csv(entity, rows):
+    buf = BytesIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        row = dict(row, entity=entity)
+        writer.writerow([cell(row.get(name)) for name in CSV_HEADER])
+    return buf.getvalue()
+
+
+def cell(value):
+    if value is None:
+        return b''
+    if isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def export(format='ndjson', entities=ENTITIES, after=None, gzip=False, progress=None):
+    """Yield the export as chunks of bytes, one per batch of rows, gzipped
+    on the fly if asked. Once a chunk has been consumed, `progress` is
+    called with the entity and id of its last row, which is where an
+    interrupted export resumes from."""
+    encode = encode_csv if format == 'csv' else encode_ndjson
+    level = current_app.config.get('CATALOG_COMPRESS_LEVEL', 6)
+    # wbits 31 writes the gzip format
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31) if gzip else None
+
+    def output(data):
+        if compressor is None:
+            return data
+        # flushed at every chunk, so that what was received decompresses
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    if format == 'csv' and after is None:
+        yield output(b','.join(name.encode('ascii') for name in CSV_HEADER) + b'\r\n')
+    for entity, rows in iter_rows(entities, after):
+        yield output(encode(entity, rows))
+        if progress is not None:
+            progress(entity, rows[-1]['id'])
+    if compressor is not None:
+        yield compressor.flush()
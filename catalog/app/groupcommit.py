@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+try:
+    from Queue import Empty, Queue
+except ImportError:
+    from queue import Empty, Queue
+from flask import abort
+from sqlalchemy import inspect
+from . import db
+
+
+class Job(object):
+    """One new row waiting for the group commit, and its outcome."""
+
+    def __init__(self, obj):
+        state = inspect(obj)
+        self.model = state.mapper.class_
+        self.pk = state.mapper.get_property_by_column(state.mapper.primary_key[0]).key
+        self.values = dict((prop.key, state.dict[prop.key]) for prop in state.mapper.column_attrs
+                           if prop.key in state.dict)
+        self.done = threading.Event()
+        self.id = None
+        self.error = None
+        # both guarded by the committer lock
+        self.taken = False
+        self.cancelled = False
+
+    def build(self):
+        # a fresh object per attempt, so that a rolled back attempt leaves
+        # nothing behind
+        return self.model(**self.values)
+
+
+class GroupCommitter(object):
+    """Coalesce the inserts of concurrent requests into shared transactions.
+
+    Requests hand their new object to a background thread and wait. The
+    thread inserts everything queued within CATALOG_GROUP_COMMIT_INTERVAL
+    seconds, up to CATALOG_GROUP_COMMIT_SIZE rows, and commits once. Each
+    request only returns after the transaction holding its row committed.
+    If the shared transaction fails, its rows are retried one transaction
+    each so that only the offending requests see the error. Requests give
+    up with a 503 after CATALOG_GROUP_COMMIT_TIMEOUT seconds if their row
+    is still queued, which then never gets inserted; rows already in a
+    batch are waited for."""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.batches = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get('CATALOG_GROUP_COMMIT', False)
+        self.interval = app.config.get('CATALOG_GROUP_COMMIT_INTERVAL', 0.005)
+        self.size = app.config.get('CATALOG_GROUP_COMMIT_SIZE', 100)
+        self.timeout = app.config.get('CATALOG_GROUP_COMMIT_TIMEOUT', 30)
+        with self.lock:
+            if self.queue is not None:
+                # stop the flusher serving the previous app
+                self.queue.put(None)
+            self.queue = None
+
+    def add(self, obj):
+        """Insert `obj` and commit, then set its primary key."""
+        if not self.enabled:
+            db.session.add(obj)
+            db.session.commit()
+            return
+        job = Job(obj)
+        self.get_queue().put(job)
+        if not job.done.wait(self.timeout):
+            with self.lock:
+                job.cancelled = not job.taken
+            if job.cancelled:
+                abort(503)
+            # its batch is in flight, only its outcome tells what happened
+            job.done.wait()
+        if job.error is not None:
+            raise job.error
+        setattr(obj, job.pk, job.id)
+
+    def get_queue(self):
+        with self.lock:
+            if self.queue is None or self.pid != os.getpid():
+                self.queue = Queue()
+                self.pid = os.getpid()
+                self.thread = None
+            if self.thread is None or not self.thread.is_alive():
+                # a flusher that died leaves its queue to the next one
+                self.thread = threading.Thread(target=self.run, args=(self.app, self.queue))
+                self.thread.daemon = True
+                self.thread.start()
+            return self.queue
+
+    def run(self, app, queue):
+        stop = False
+        while not stop:
+            job = queue.get()
+            if job is None:
+                return
+            if not self.take(job):
+                continue
+            batch = [job]
+            deadline = time.time() + self.interval
+            while len(batch) < self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    job = queue.get(timeout=remaining)
+                except Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                if self.take(job):
+                    batch.append(job)
+            with app.app_context():
+                try:
+                    self.commit(batch)
+                except Exception as e:
+                    # even a failed rollback must not pass for a commit
+                    for job in batch:
+                        if job.id is None and job.error is None:
+                            job.error = e
+                finally:
+                    try:
+                        db.session.remove()
+                    finally:
+                        for job in batch:
+                            job.done.set()
+
+    def take(self, job):
+        """Claim `job` for a batch, unless its request gave up on it."""
+        with self.lock:
+            job.taken = not job.cancelled
+            return job.taken
+
+    def commit(self, batch):
+        session = db.session()
+        try:
+            objs = [job.build() for job in batch]
+            session.add_all(objs)
+            session.flush()
+            ids = [getattr(obj, job.pk) for job, obj in zip(batch, objs)]
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            if len(batch) == 1:
+                batch[0].error = e
+            else:
+                for job in batch:
+                    self.commit([job])
+            return
+        self.batches += 1
+        for job, id in zip(batch, ids):
+            job.id = id
+
+
+commits = GroupCommitter()
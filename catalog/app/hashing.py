@@ -0,0 +1,29 @@
+import os
+import threading
+from multiprocessing import Pool, cpu_count
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+# one pool per process, recreated after a fork
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+
+
+def get_pool(workers):
+    global _pool, _pool_pid
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = Pool(workers)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def hash_passwords(passwords):
+    """Hash many passwords at once, spread over PASSWORD_HASH_WORKERS
+    processes (one per core by default)."""
+    workers = current_app.config.get('PASSWORD_HASH_WORKERS') or cpu_count()
+    if workers < 2 or len(passwords) < 2:
+        return [generate_password_hash(password) for password in passwords]
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return get_pool(workers).map(generate_password_hash, passwords, chunksize)
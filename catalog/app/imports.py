@@ -0,0 +1,347 @@
+import csv
+import errno
+import json
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from sqlalchemy.exc import IntegrityError
+from . import db
+from .bulk import chunks, insert_items, prepare_items
+from .exceptions import ValidationError
+from .models import Category, ImportJob
+
+FORMATS = {'application/x-ndjson': 'ndjson', 'text/csv': 'csv'}
+# attempts at a chunk that keeps losing titles or names to concurrent writers
+ATTEMPTS = 3
+
+
+class Importer(object):
+    """Import jobs run by a pool of CATALOG_IMPORT_WORKERS threads in each
+    process. Uploads are spooled to CATALOG_IMPORT_DIR and imported
+    CATALOG_IMPORT_CHUNK rows per transaction, each transaction also
+    recording the job's progress. Jobs record the process running them,
+    so that the jobs of a process that died can be recovered."""
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+        self.threads = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get('CATALOG_IMPORT_WORKERS', 2)
+        self.directory = app.config.get('CATALOG_IMPORT_DIR') or \
+            os.path.join(tempfile.gettempdir(), 'catalog_imports')
+        self.chunk = app.config.get('CATALOG_IMPORT_CHUNK', 1000)
+        self.max_errors = app.config.get('CATALOG_IMPORT_MAX_ERRORS', 100)
+        with self.lock:
+            if self.queue is not None:
+                # stop the workers serving the previous app
+                for _ in range(self.threads):
+                    self.queue.put(None)
+            self.queue = None
+
+    def submit(self, stream, format):
+        """Spool the upload in `stream` and queue a job importing it."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, uuid.uuid4().hex + '.' + format)
+        size = 0
+        with open(path, 'wb') as f:
+            while True:
+                data = stream.read(65536)
+                if not data:
+                    break
+                f.write(data)
+                size += len(data)
+        job = ImportJob(format=format, path=path, size=size, owner=os.getpid())
+        db.session.add(job)
+        db.session.commit()
+        self.get_queue().put(job.id)
+        return job
+
+    def get_queue(self):
+        with self.lock:
+            if self.queue is None or self.pid != os.getpid():
+                self.queue = Queue()
+                self.pid = os.getpid()
+                self.threads = self.workers
+                for _ in range(self.workers):
+                    thread = threading.Thread(target=self.run, args=(self.app, self.queue))
+                    thread.daemon = True
+                    thread.start()
+            return self.queue
+
+    def recover(self):
+        """Take over the jobs of the processes that died: queued jobs are
+        run again, jobs that were running are failed, since their file is
+        partly imported."""
+        pid = os.getpid()
+        for job in ImportJob.query.filter(ImportJob.status.in_(['queued', 'running'])).all():
+            if alive(job.owner):
+                continue
+            # several new processes may recover at once, only one claims the job
+            claimed = ImportJob.query.filter_by(id=job.id, status=job.status, owner=job.owner) \
+                .update({'owner': pid}, synchronize_session=False)
+            if not claimed:
+                db.session.rollback()
+                continue
+            job.owner = pid
+            if job.status == 'queued' and os.path.exists(job.path):
+                db.session.commit()
+                self.get_queue().put(job.id)
+                continue
+            job.status = 'failed'
+            job.message = 'Interrupted: the process running the job died'
+            job.finished = datetime.utcnow()
+            db.session.commit()
+            if os.path.exists(job.path):
+                os.remove(job.path)
+
+    def run(self, app, queue):
+        while True:
+            job_id = queue.get()
+            if job_id is None:
+                return
+            with app.app_context():
+                try:
+                    run_job(job_id, self.chunk, self.max_errors)
+                except Exception as e:
+                    # run_job fails its own job, unless recording that failed too
+                    db.session.rollback()
+                    try:
+                        fail_job(job_id, e)
+                    except Exception:
+                        db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+importer = Importer()
+
+
+def alive(pid):
+    """Whether process `pid` of this host is still running."""
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class CountingReader(object):
+    """Iterate over the lines of a binary file, counting the bytes read."""
+
+    def __init__(self, f):
+        self.f = f
+        self.position = 0
+
+    def __iter__(self):
+        for line in self.f:
+            self.position += len(line)
+            yield line
+
+
+def parse_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line.decode('utf-8'))
+        except ValueError:
+            yield number, 'Invalid row: not JSON'
+            continue
+        yield number, data if isinstance(data, dict) else 'Invalid row: expected an object'
+
+
+def parse_csv(lines):
+    reader = csv.reader(lines)
+    header = None
+    for row in reader:
+        if header is None:
+            header = [name.decode('utf-8') if isinstance(name, bytes) else name for name in row]
+            continue
+        # the line the row ends on, the header being line 1
+        number = reader.line_num
+        cells = [cell.decode('utf-8') if isinstance(cell, bytes) else cell for cell in row]
+        if len(cells) != len(header):
+            yield number, 'Invalid row: expected %d cells' % len(header)
+            continue
+        # empty cells are kept: the export writes null descriptions as such
+        yield number, dict(zip(header, cells))
+
+
+def parse(lines, format):
+    """Yield (line, entry) for every row, entry being the row's dict or an
+    error message. Rows are items unless their entity says otherwise."""
+    rows = parse_csv(lines) if format == 'csv' else parse_ndjson(lines)
+    for number, data in rows:
+        if isinstance(data, dict):
+            data = dict(data)
+            entity = data.pop('entity', 'items')
+            data['entity'] = entity
+            if entity not in ('items', 'categories'):
+                data = 'Invalid row: unknown entity ' + entity
+            elif entity == 'items' and 'category' in data:
+                try:
+                    data['category'] = int(data['category'])
+                except (TypeError, ValueError):
+                    data = 'Invalid item: category must be an id'
+        yield number, data
+
+
+def batches(entries, size):
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_categories(entries):
+    """Add the categories among `entries`, (line, data) pairs, to the
+    session. Returns the errors and the number added."""
+    errors = []
+    categories = []
+    for number, data in entries:
+        try:
+            categories.append((number, Category().import_data(data)))
+        except ValidationError as e:
+            errors.append({'line': number, 'error': e.args[0]})
+    taken = set()
+    for chunk in chunks([category.name for number, category in categories]):
+        taken.update(name for (name,) in
+                     db.session.query(Category.name).filter(Category.name.in_(chunk)))
+    added = 0
+    for number, category in categories:
+        if category.name in taken:
+            errors.append({'line': number,
+                           'error': 'Conflict: a category named ' + category.name + ' already exists'})
+            continue
+        taken.add(category.name)
+        db.session.add(category)
+        added += 1
+    db.session.flush()
+    return errors, added
+
+
+def import_items(entries):
+    """Insert the items among `entries` with the rules of the batch
+    endpoint. Returns the errors and the number inserted."""
+    results, rows = prepare_items([data for number, data in entries])
+    errors = [{'line': entries[index][0], 'error': result['error']}
+              for index, result in enumerate(results) if result is not None]
+    cat_ids = set(row['cat_id'] for index, row in rows)
+    existing = set()
+    for chunk in chunks(list(cat_ids)):
+        existing.update(id for (id,) in db.session.query(Category.id).filter(Category.id.in_(chunk)))
+    valid = []
+    for index, row in rows:
+        if row['cat_id'] in existing:
+            valid.append(row)
+        else:
+            errors.append({'line': entries[index][0],
+                           'error': 'Invalid item: no category ' + str(row['cat_id'])})
+    if valid:
+        insert_items(valid)
+    errors.sort(key=lambda error: error['line'])
+    return errors, len(valid)
+
+
+def import_batch(job, batch, position, max_errors):
+    """Import one batch of (line, entry) pairs and record the progress of
+    `job` in the same transaction."""
+    for attempt in range(ATTEMPTS):
+        errors = [{'line': number, 'error': data} for number, data in batch
+                  if not isinstance(data, dict)]
+        entries = [(number, data) for number, data in batch if isinstance(data, dict)]
+        try:
+            # categories first, so that items of the same batch can use them
+            category_errors, categories = import_categories(
+                [(number, data) for number, data in entries if data['entity'] == 'categories'])
+            item_errors, items = import_items(
+                [(number, data) for number, data in entries if data['entity'] == 'items'])
+            errors = sorted(errors + category_errors + item_errors, key=lambda error: error['line'])
+            job.rows += len(batch)
+            job.categories += categories
+            job.items += items
+            job.position = position
+            job.error_count += len(errors)
+            if errors and job.error_count - len(errors) < max_errors:
+                job.errors = json.dumps((json.loads(job.errors) + errors)[:max_errors])
+            db.session.commit()
+            return
+        except IntegrityError:
+            # a title or name was taken since it was checked, check again
+            db.session.rollback()
+            if attempt == ATTEMPTS - 1:
+                raise
+
+
+def run_job(job_id, chunk=1000, max_errors=100):
+    """Import the file of job `job_id`, a batch of `chunk` rows per
+    transaction. This is the unit of work of any backend."""
+    job = ImportJob.query.get(job_id)
+    job.status = 'running'
+    job.owner = os.getpid()
+    job.started = datetime.utcnow()
+    db.session.commit()
+    try:
+        with open(job.path, 'rb') as f:
+            reader = CountingReader(f)
+            for batch in batches(parse(iter(reader), job.format), chunk):
+                import_batch(job, batch, reader.position, max_errors)
+        job.status = 'done'
+    except Exception as e:
+        db.session.rollback()
+        job.status = 'failed'
+        job.message = error_message(e)
+    job.finished = datetime.utcnow()
+    db.session.commit()
+    if os.path.exists(job.path):
+        os.remove(job.path)
+
+
+def fail_job(job_id, e):
+    """Record that job `job_id` failed with `e` outside of run_job."""
+    job = ImportJob.query.get(job_id)
+    job.status = 'failed'
+    job.message = error_message(e)
+    job.finished = datetime.utcnow()
+    db.session.commit()
+    if os.path.exists(job.path):
+        os.remove(job.path)
+
+
+def error_message(e):
+    return ('%s: %s' % (e.__class__.__name__, e))[:255]
+
+
+def status(job):
+    """Return the progress report of `job`."""
+    elapsed = 0
+    if job.started is not None:
+        elapsed = ((job.finished or datetime.utcnow()) - job.started).total_seconds()
+    return {'id': job.id, 'status': job.status, 'format': job.format,
+            'size': job.size, 'position': job.position,
+            'progress': round(float(job.position) / job.size, 4) if job.size else 1.0,
+            'rows': job.rows, 'categories': job.categories, 'items': job.items,
+            'rows_per_second': round(job.rows / elapsed, 1) if elapsed else 0,
+            'error_count': job.error_count, 'errors': json.loads(job.errors),
+            'message': job.message,
+            'created': job.created.isoformat() + 'Z',
+            'started': job.started.isoformat() + 'Z' if job.started else None,
+            'finished': job.finished.isoformat() + 'Z' if job.finished else None}
@@ -0,0 +1,184 @@
+import threading
+import time
+from bisect import bisect_left
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# upper bounds in seconds, from half a millisecond to ten seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """A fixed-bucket histogram, e.g. of latencies in seconds. Observing
+    a value costs one bisect and one short lock."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Return the cumulative bucket counts as (upper bound, count)
+        pairs ending with '+Inf', the number of values and their sum."""
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return {'buckets': buckets, 'count': cumulative, 'sum': total}
+
+
+class Series(object):
+    """Counters and latency histogram of one (endpoint, method, status)."""
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.bytes = 0
+        self.statements = 0
+
+    def observe(self, seconds, size, statements):
+        self.latency.observe(seconds)
+        with self.latency.lock:
+            self.bytes += size
+            self.statements += statements
+
+
+class RequestMetrics(object):
+    """Per endpoint request counts, latencies, response sizes and SQL
+    statement counts, exported in the Prometheus text format at /metrics.
+    Recording a request takes a dict lookup and two short locks."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+        self.local = threading.local()
+
+    def init_app(self, app):
+        self.reset()
+        if not app.config.get('CATALOG_METRICS', True):
+            return
+        app.before_request(self.start)
+        app.after_request(self.finish)
+        app.add_url_rule('/metrics', 'metrics', self.export)
+
+    def reset(self):
+        with self.lock:
+            self.series = {}
+
+    def start(self):
+        self.local.start = time.time()
+        self.local.statements = 0
+
+    def count_statement(self):
+        try:
+            self.local.statements += 1
+        except AttributeError:
+            # not inside a request, e.g. the group commit thread
+            pass
+
+    def finish(self, response):
+        start = getattr(self.local, 'start', None)
+        if start is None:
+            return response
+        key = (request.endpoint or 'unmatched', request.method, response.status_code)
+        series = self.series.get(key)
+        if series is None:
+            with self.lock:
+                series = self.series.setdefault(key, Series())
+        series.observe(time.time() - start, response.content_length or 0, self.local.statements)
+        del self.local.start, self.local.statements
+        return response
+
+    def export(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        series = [({'endpoint': endpoint, 'method': method, 'status': status}, s)
+                  for (endpoint, method, status), s in series]
+        snapshots = [(labels, s.latency.snapshot()) for labels, s in series]
+        lines = []
+        add_family(lines, 'catalog_http_requests_total', 'counter', 'Requests handled.',
+                   [(labels, snapshot['count']) for labels, snapshot in snapshots])
+        add_family(lines, 'catalog_http_request_duration_seconds', 'histogram',
+                   'Time spent handling requests.', snapshots)
+        add_family(lines, 'catalog_http_response_bytes_total', 'counter',
+                   'Bytes sent in response bodies.', [(labels, s.bytes) for labels, s in series])
+        add_family(lines, 'catalog_http_sql_statements_total', 'counter',
+                   'SQL statements executed while handling requests.',
+                   [(labels, s.statements) for labels, s in series])
+        add_pool_families(lines)
+        add_cache_families(lines)
+        return current_app.response_class('\n'.join(lines) + '\n',
+                                          mimetype='text/plain; version=0.0.4')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"').replace('\n', '\\n'))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+def add_family(lines, name, kind, help, samples):
+    """Append one metric family in the Prometheus text format. `samples`
+    are (labels, value) pairs; histogram values are snapshots."""
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for labels, value in samples:
+        if kind != 'histogram':
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+            continue
+        for bound, count in value['buckets']:
+            le = bound if bound == '+Inf' else '%g' % bound
+            lines.append('%s_bucket%s %d' % (name, format_labels(dict(labels, le=le)), count))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels), value['sum']))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), value['count']))
+
+
+def add_pool_families(lines):
+    from . import db
+    from .pool import stats
+    report = stats.report(db.engine.pool)
+    for key in ('connects', 'checkouts', 'checkins', 'invalidations', 'timeouts'):
+        add_family(lines, 'catalog_db_pool_%s_total' % key, 'counter',
+                   'Connection pool %s.' % key, [({}, report[key])])
+    for key in ('checked_out', 'checked_in', 'size', 'overflow'):
+        if key in report:
+            add_family(lines, 'catalog_db_pool_' + key, 'gauge',
+                       'Connection pool %s.' % key.replace('_', ' '), [({}, report[key])])
+    add_family(lines, 'catalog_db_pool_wait_seconds', 'histogram',
+               'Time checkouts waited for a connection.', [({}, report['wait'])])
+    add_family(lines, 'catalog_db_pool_checkout_seconds', 'histogram',
+               'Time taken by whole checkouts.', [({}, report['checkout_latency'])])
+
+
+def add_cache_families(lines):
+    from .cache import entities, tokens
+    from .compression import payloads
+    caches = [('entities', entities.stats()), ('tokens', tokens.stats()),
+              ('payloads', payloads.stats())]
+    for key in ('hits', 'misses', 'evictions', 'invalidations'):
+        add_family(lines, 'catalog_cache_%s_total' % key, 'counter', 'Cache %s.' % key,
+                   [({'cache': name}, data[key]) for name, data in caches])
+    add_family(lines, 'catalog_cache_size', 'gauge', 'Entries in the cache.',
+               [({'cache': name}, data['size']) for name, data in caches])
+
+
+metrics = RequestMetrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    metrics.count_statement()
@@ -1,9 +1,28 @@
+from datetime import datetime
 from flask import current_app
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, BadSignature
 from . import db
 from .exceptions import ValidationError
 
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = (int,)
+
+# token serializers, reused across requests and keyed by (secret, lifetime)
+_serializers = {}
+
+
+def token_serializer(expires_in=None):
+    key = (current_app.config['SECRET_KEY'], expires_in)
+    s = _serializers.get(key)
+    if s is None:
+        s = _serializers[key] = Serializer(key[0], expires_in=expires_in)
+    return s
+
 
 # User Model
 class User(db.Model):
@@ -19,16 +38,24 @@ class User(db.Model):
         return check_password_hash(self.password_hash, password)
 
     def generate_auth_token(self, expires_in=3600):
-        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expires_in)
+        s = token_serializer(expires_in)
         return s.dumps({'id': self.id}).decode('utf-8')
 
     @staticmethod
-    def verify_auth_token(token):
-        s = Serializer(current_app.config['SECRET_KEY'])
+    def read_auth_token(token):
+        # return the token's payload with its expiry time added as 'exp'
         try:
-            data = s.loads(token)
+            data, header = token_serializer().loads(token, return_header=True)
         except BadSignature:
             return None
+        data['exp'] = header['exp']
+        return data
+
+    @staticmethod
+    def verify_auth_token(token):
+        data = User.read_auth_token(token)
+        if data is None:
+            return None
         return User.query.get(data['id'])
 
 
@@ -38,13 +65,18 @@ class Category(db.Model):
     __tablename__ = 'categories'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True, nullable=None)
+    # kept up to date by the item write paths, see counts.py
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     items = db.relationship('Item', backref='category', lazy='dynamic')
 
     def import_data(self, data):
         try:
-            self.name = data['name']
+            name = data['name']
         except KeyError as e:
             raise ValidationError('Invalid category: missing ' + e.args[0])
+        if not isinstance(name, string_types) or not name:
+            raise ValidationError('Invalid category: name must be a non-empty string')
+        self.name = name
         return self
 
 
@@ -59,9 +91,57 @@ class Item(db.Model):
 
     def import_data(self, data):
         try:
-            self.title = data['title']
-            self.description = data['description']
-            self.cat_id = data['category']
+            title, description, cat_id = data['title'], data['description'], data['category']
         except KeyError as e:
             raise ValidationError('Invalid item: missing ' + e.args[0])
+        if not isinstance(title, string_types) or not title:
+            raise ValidationError('Invalid item: title must be a non-empty string')
+        # descriptions are optional in the table, and exported as null
+        if description is not None and not isinstance(description, string_types):
+            raise ValidationError('Invalid item: description must be a string')
+        self.title = title
+        self.description = description
+        self.cat_id = cat_id
         return self
+
+
+# Entry of the change feed: an item or category written or deleted, see changes.py
+class Change(db.Model):
+    __tablename__ = 'changes'
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(16), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Background import of an uploaded file, see imports.py
+class ImportJob(db.Model):
+    __tablename__ = 'imports'
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    format = db.Column(db.String(16), nullable=False)
+    path = db.Column(db.String(255), nullable=False)
+    # the process whose workers run the job
+    owner = db.Column(db.Integer)
+    # bytes uploaded and bytes processed so far
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    position = db.Column(db.BigInteger, nullable=False, default=0)
+    rows = db.Column(db.Integer, nullable=False, default=0)
+    categories = db.Column(db.Integer, nullable=False, default=0)
+    items = db.Column(db.Integer, nullable=False, default=0)
+    error_count = db.Column(db.Integer, nullable=False, default=0)
+    # JSON list of the first errors, each with its line
+    errors = db.Column(db.Text, nullable=False, default='[]')
+    message = db.Column(db.String(255))
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+
+# Version counter of a cached collection, e.g. 'items' or 'category:<id>'
+class Version(db.Model):
+    __tablename__ = 'versions'
+    key = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    modified = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
@@ -0,0 +1,78 @@
+import base64
+import json
+import time
+from flask import current_app, request, url_for
+from .exceptions import ValidationError
+from .versions import lookup
+
+# cached totals, keyed by the version key of the counted collection
+_counts = {}
+
+
+def encode_cursor(id):
+    cursor = json.dumps({'id': id}).encode('utf-8')
+    return base64.urlsafe_b64encode(cursor).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = str(cursor) + '=' * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))['id'])
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise ValidationError('Invalid cursor: ' + cursor)
+
+
+def page_args(cursor='after'):
+    """Return the limit and the decoded `cursor` argument requested by
+    the client."""
+    default = current_app.config.get('CATALOG_PAGE_SIZE', 100)
+    maximum = current_app.config.get('CATALOG_MAX_PAGE_SIZE', 1000)
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        raise ValidationError('Invalid limit: ' + request.args['limit'])
+    if limit < 1 or limit > maximum:
+        raise ValidationError('Invalid limit: must be between 1 and ' + str(maximum))
+    after = request.args.get(cursor)
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+
+def paginate(query, column, endpoint, **values):
+    """Return one page of `query` ordered by `column` and the URL of the
+    next page, or None when this is the last one. Query arguments other
+    than the cursor are carried over to the next page."""
+    limit, after = page_args()
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(limit + 1).all()
+    next_url = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        args = request.args.to_dict()
+        args.update(values, limit=limit, after=encode_cursor(rows[-1].id))
+        next_url = url_for(endpoint, _external=True, **args)
+    return rows, next_url
+
+
+def total_count(key, query):
+    """Return the number of rows in `query`, cached under the version key
+    `key` until that version changes or CATALOG_COUNT_TTL seconds pass."""
+    ttl = current_app.config.get('CATALOG_COUNT_TTL', 30)
+    now = time.time()
+    version = lookup([key])[key]
+    cached = _counts.get(key)
+    if cached is not None and cached[0] > now and cached[1] == version:
+        return cached[2]
+    total = query.order_by(None).count()
+    _counts[key] = (now + ttl, version, total)
+    return total
+
+
+def page(name, rows, next_url, key, query):
+    """Build the JSON document for a page of serialized `rows`."""
+    output = {name: rows, 'next': next_url}
+    if request.args.get('count') in ('1', 'true'):
+        output['total'] = total_count(key, query)
+    return output
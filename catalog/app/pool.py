@@ -0,0 +1,144 @@
+import threading
+import time
+from functools import partial
+from flask import _app_ctx_stack, g
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql.dml import UpdateBase
+from .metrics import Histogram
+
+
+class PoolStats(object):
+    """Process-wide connection pool counters, fed by pool events and by
+    the timed pool classes below."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checkins = 0
+            self.checked_out = 0
+            self.invalidations = 0
+            self.timeouts = 0
+        self.wait = Histogram()
+        self.checkout = Histogram()
+
+    def count(self, name, delta=1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def report(self, pool):
+        """Return the counters along with the state of `pool`."""
+        with self.lock:
+            data = {'connects': self.connects, 'checkouts': self.checkouts,
+                    'checkins': self.checkins, 'checked_out': self.checked_out,
+                    'invalidations': self.invalidations, 'timeouts': self.timeouts}
+        data['pool'] = pool.__class__.__name__
+        # only queue pools have a size and overflow
+        if hasattr(pool, 'overflow'):
+            data.update(size=pool.size(), overflow=pool.overflow(),
+                        checked_in=pool.checkedin(), checked_out=pool.checkedout())
+        data['wait'] = self.wait.snapshot()
+        data['checkout_latency'] = self.checkout.snapshot()
+        return data
+
+
+stats = PoolStats()
+
+
+class TimedPool(object):
+    """Mixin timing how long checkouts wait for a connection (`_do_get`)
+    and how long they take in total, pre-ping and events included."""
+
+    def _do_get(self):
+        start = time.time()
+        try:
+            return super(TimedPool, self)._do_get()
+        except exc.TimeoutError:
+            stats.count('timeouts')
+            raise
+        finally:
+            stats.wait.observe(time.time() - start)
+
+    def connect(self):
+        start = time.time()
+        try:
+            return super(TimedPool, self).connect()
+        finally:
+            stats.checkout.observe(time.time() - start)
+
+
+_timed = {}
+
+
+def timed(poolclass):
+    """Return a subclass of `poolclass` that records its timings."""
+    if poolclass not in _timed:
+        _timed[poolclass] = type('Timed' + poolclass.__name__, (TimedPool, poolclass), {})
+    return _timed[poolclass]
+
+
+class RoutingSession(_SignallingSession):
+    """Session reading from the replica chosen for the request in
+    `g.replica`, if any. The first write, flushed or executed, clears
+    it so that the rest of the request uses the primary."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if _app_ctx_stack.top is not None and getattr(g, 'replica', None) is not None:
+            if not self._flushing and not isinstance(clause, UpdateBase):
+                return g.replica
+            g.replica = None
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with pre-ping, timed pools and replica routing.
+
+    Pool sizing comes from the usual SQLALCHEMY_POOL_SIZE,
+    SQLALCHEMY_MAX_OVERFLOW, SQLALCHEMY_POOL_TIMEOUT and
+    SQLALCHEMY_POOL_RECYCLE settings; SQLALCHEMY_POOL_PRE_PING tests
+    every connection before handing it out."""
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options), scopefunc=scopefunc)
+
+    def apply_pool_defaults(self, app, options):
+        super(PooledSQLAlchemy, self).apply_pool_defaults(app, options)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING', False):
+            options['pool_pre_ping'] = True
+
+    def apply_driver_hacks(self, app, info, options):
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        poolclass = options.get('poolclass') or info.get_dialect().get_pool_class(info)
+        options['poolclass'] = timed(poolclass)
+
+
+@event.listens_for(Pool, 'connect')
+def count_connect(dbapi_connection, connection_record):
+    stats.count('connects')
+
+
+@event.listens_for(Pool, 'checkout')
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    with stats.lock:
+        stats.checkouts += 1
+        stats.checked_out += 1
+
+
+@event.listens_for(Pool, 'checkin')
+def count_checkin(dbapi_connection, connection_record):
+    with stats.lock:
+        stats.checkins += 1
+        stats.checked_out -= 1
+
+
+@event.listens_for(Pool, 'invalidate')
+def count_invalidate(dbapi_connection, connection_record, exception):
+    stats.count('invalidations')
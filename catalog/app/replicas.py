@@ -0,0 +1,93 @@
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, request
+from . import db
+
+# remembers until when a client that wrote must read from the primary
+COOKIE = 'catalog_primary_until'
+
+
+class Replicas(object):
+    """Read replicas for the GET endpoints.
+
+    SQLALCHEMY_REPLICA_URIS lists the replicas, which become the binds
+    replica0, replica1... CATALOG_REPLICA_SELECTION picks one per request,
+    'round-robin' or 'least-busy' (fewest requests in flight from this
+    process). After a successful write, a client reads from the primary
+    for CATALOG_READ_YOUR_WRITES seconds."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.binds = []
+        self.busy = []
+        self.next = 0
+
+    def init_app(self, app):
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+        self.selection = app.config.get('CATALOG_REPLICA_SELECTION', 'round-robin')
+        if self.selection not in ('round-robin', 'least-busy'):
+            raise ValueError('Invalid CATALOG_REPLICA_SELECTION: ' + self.selection)
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        with self.lock:
+            self.binds = ['replica%d' % i for i in range(len(uris))]
+            self.busy = [0] * len(uris)
+            self.next = 0
+        binds.update(zip(self.binds, uris))
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    def acquire(self):
+        """Return the index of the replica for this request, or None if
+        it must read from the primary."""
+        if not self.binds or primary_until() > time.time() or request.environ.get('catalog.primary'):
+            return None
+        with self.lock:
+            if self.selection == 'least-busy':
+                # ties go round-robin
+                order = [(self.next + i) % len(self.binds) for i in range(len(self.binds))]
+                index = min(order, key=lambda i: self.busy[i])
+            else:
+                index = self.next
+            self.next = (index + 1) % len(self.binds)
+            self.busy[index] += 1
+        return index
+
+    def release(self, index):
+        with self.lock:
+            self.busy[index] -= 1
+
+
+replicas = Replicas()
+
+
+def primary_until():
+    try:
+        return float(request.cookies.get(COOKIE, 0))
+    except ValueError:
+        return 0
+
+
+def read_replica(f):
+    """Send the reads of a view to a replica. The session returns to
+    the primary for the rest of the request once it writes."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        index = replicas.acquire()
+        if index is None:
+            return f(*args, **kwargs)
+        g.replica = db.get_engine(current_app, replicas.binds[index])
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.replica = None
+            replicas.release(index)
+    return wrapped
+
+
+def remember_writes(response):
+    """after_request hook keeping a client that just wrote on the primary."""
+    window = current_app.config.get('CATALOG_READ_YOUR_WRITES', 5)
+    if replicas.binds and window and request.method not in ('GET', 'HEAD', 'OPTIONS') \
+            and response.status_code < 400:
+        response.set_cookie(COOKIE, '%.3f' % (time.time() + window), max_age=int(window) + 1)
+    return response
@@ -0,0 +1,277 @@
+import math
+import re
+import threading
+from weakref import WeakKeyDictionary
+from flask import current_app
+from sqlalchemy import DDL, bindparam, event, func, text
+from sqlalchemy.orm import Session
+from . import db
+from .models import Change, Item
+from .streaming import iter_batches
+from .versions import lookup
+
+# how many ids go into one IN (...)
+CHUNK_SIZE = 500
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def words(value):
+    return WORD.findall(value.lower()) if value else []
+
+
+def chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def has_fts5(bind):
+    return bind.dialect.name == 'sqlite' and bool(
+        bind.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar())
+
+
+# the full-text indexes are created and dropped along with the items table
+event.listen(Item.__table__, 'after_create',
+             DDL('CREATE VIRTUAL TABLE items_fts USING fts5(title, description)')
+             .execute_if(callable_=lambda ddl, target, bind, **kw: has_fts5(bind)))
+event.listen(Item.__table__, 'before_drop',
+             DDL('DROP TABLE IF EXISTS items_fts').execute_if(dialect='sqlite'))
+event.listen(Item.__table__, 'after_create',
+             DDL('ALTER TABLE items ADD FULLTEXT INDEX ix_items_fulltext (title, description)')
+             .execute_if(dialect='mysql'))
+
+
+class FTS5Index(object):
+    """SQLite FTS5 table kept in step with the items table, ranked by BM25
+    with titles weighted twice as much as descriptions."""
+
+    def reindex(self, session, ids):
+        for chunk in chunks(ids):
+            session.execute(text('DELETE FROM items_fts WHERE rowid IN :ids')
+                            .bindparams(bindparam('ids', expanding=True)), {'ids': chunk})
+            session.execute(text('INSERT INTO items_fts (rowid, title, description) '
+                                 'SELECT id, title, description FROM items WHERE id IN :ids')
+                            .bindparams(bindparam('ids', expanding=True)), {'ids': chunk})
+
+    def search(self, query, limit, offset):
+        terms = ' '.join('"' + word + '"' for word in words(query))
+        if not terms:
+            return []
+        rows = db.session.execute(text('SELECT rowid FROM items_fts WHERE items_fts MATCH :terms '
+                                       'ORDER BY bm25(items_fts, 2.0, 1.0), rowid '
+                                       'LIMIT :limit OFFSET :offset'),
+                                  {'terms': terms, 'limit': limit, 'offset': offset})
+        return [id for (id,) in rows]
+
+    def rebuild(self, session):
+        session.execute(text('CREATE VIRTUAL TABLE IF NOT EXISTS items_fts '
+                             'USING fts5(title, description)'))
+        session.execute(text('DELETE FROM items_fts'))
+        session.execute(text('INSERT INTO items_fts (rowid, title, description) '
+                             'SELECT id, title, description FROM items'))
+
+
+class MySQLIndex(object):
+    """MySQL FULLTEXT index, which InnoDB maintains by itself."""
+
+    def reindex(self, session, ids):
+        pass
+
+    def search(self, query, limit, offset):
+        if not words(query):
+            return []
+        rows = db.session.execute(text('SELECT id FROM items '
+                                       'WHERE MATCH (title, description) AGAINST (:query) '
+                                       'ORDER BY MATCH (title, description) AGAINST (:query) DESC, id '
+                                       'LIMIT :limit OFFSET :offset'),
+                                  {'query': query, 'limit': limit, 'offset': offset})
+        return [id for (id,) in rows]
+
+    def rebuild(self, session):
+        found = session.execute(text("SHOW INDEX FROM items WHERE Key_name = 'ix_items_fulltext'"))
+        if found.first() is None:
+            session.execute(text('ALTER TABLE items ADD FULLTEXT INDEX ix_items_fulltext '
+                                 '(title, description)'))
+
+
+class MemoryIndex(object):
+    """In-process inverted index for databases without full-text search.
+    It is built from one scan of the items table on first use and then
+    follows the writes committed by this process. It also remembers the
+    items version and the last change it reflects, and catches up from
+    the change feed on the writes of other processes once the version
+    moved."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        self.postings = {}
+        self.documents = {}
+        self.version = None
+        self.change_id = 0
+
+    def add(self, id, title, description):
+        counts = {}
+        # title words count twice
+        for word in words(title) * 2 + words(description):
+            counts[word] = counts.get(word, 0) + 1
+        self.documents[id] = counts
+        for word, count in counts.items():
+            self.postings.setdefault(word, {})[id] = count
+
+    def remove(self, id):
+        for word in self.documents.pop(id, {}):
+            posting = self.postings[word]
+            del posting[id]
+            if not posting:
+                del self.postings[word]
+
+    def reindex(self, session, ids):
+        # read the new rows inside the transaction, apply them once it commits
+        pending = session.info.setdefault('search_pending', {})
+        for id in ids:
+            pending[id] = None
+        for chunk in chunks(ids):
+            for id, title, description in session.query(Item.id, Item.title, Item.description) \
+                    .filter(Item.id.in_(chunk)):
+                pending[id] = (title, description)
+        session.info['search_index'] = self
+
+    def apply(self, pending):
+        with self.lock:
+            if not self.built:
+                return
+            for id, row in pending.items():
+                self.remove(id)
+                if row is not None:
+                    self.add(id, *row)
+
+    def build(self):
+        with self.lock:
+            if self.built:
+                return
+            # read first, so that writes racing the scan are caught up on
+            self.version = lookup(['items'])['items'][0]
+            self.change_id = db.session.query(func.max(Change.id)).scalar() or 0
+            query = db.session.query(Item.id, Item.title, Item.description)
+            for rows in iter_batches(query, Item.id):
+                for id, title, description in rows:
+                    self.add(id, title, description)
+            self.built = True
+
+    def catch_up(self):
+        """Apply the item writes logged since the index was last brought
+        up to date, if the items version moved since."""
+        version = lookup(['items'])['items'][0]
+        with self.lock:
+            if version == self.version:
+                return
+            after = self.change_id
+        last = after
+        pending = {}
+        for id, entity_id in db.session.query(Change.id, Change.entity_id) \
+                .filter(Change.entity == 'items', Change.id > after).order_by(Change.id):
+            pending[entity_id] = None
+            last = id
+        for chunk in chunks(pending):
+            for id, title, description in db.session.query(Item.id, Item.title, Item.description) \
+                    .filter(Item.id.in_(chunk)):
+                pending[id] = (title, description)
+        self.apply(pending)
+        with self.lock:
+            # writes apply in any order, the newest row being read each time
+            self.version = max(self.version, version)
+            self.change_id = max(self.change_id, last)
+
+    def search(self, query, limit, offset):
+        self.build()
+        self.catch_up()
+        terms = set(words(query))
+        with self.lock:
+            postings = [self.postings.get(word, {}) for word in terms]
+            if not postings or not all(postings):
+                return []
+            total = len(self.documents)
+            postings.sort(key=len)
+            scores = {}
+            for id in postings[0]:
+                if all(id in posting for posting in postings[1:]):
+                    scores[id] = sum(posting[id] * math.log(1.0 + float(total) / len(posting))
+                                     for posting in postings)
+        ranked = sorted(scores, key=lambda id: (-scores[id], id))
+        return ranked[offset:offset + limit]
+
+    def rebuild(self, session):
+        with self.lock:
+            self.built = False
+            self.postings = {}
+            self.documents = {}
+            self.version = None
+            self.change_id = 0
+
+
+# the index in use for each engine
+_indexes = WeakKeyDictionary()
+
+
+def get_index(engine=None):
+    engine = engine or db.get_engine(current_app)
+    index = _indexes.get(engine)
+    if index is None:
+        backend = current_app.config.get('CATALOG_SEARCH_BACKEND')
+        if backend is None:
+            if engine.dialect.name == 'mysql':
+                backend = 'mysql'
+            elif engine.dialect.name == 'sqlite' and engine.has_table('items_fts'):
+                backend = 'fts5'
+            else:
+                backend = 'memory'
+        index = _indexes[engine] = {'fts5': FTS5Index, 'mysql': MySQLIndex,
+                                    'memory': MemoryIndex}[backend]()
+    return index
+
+
+def search(query, limit, offset=0):
+    """Return the ids of the items best matching `query`, best first."""
+    return get_index().search(query, limit, offset)
+
+
+def reindex(ids, session=None):
+    """Bring the index up to date for the items `ids`, which may have been
+    inserted, changed or deleted in the session's transaction."""
+    session = session or db.session()
+    if ids:
+        # the session may be bound to a connection rather than its engine
+        get_index(session.bind.engine).reindex(session, ids)
+
+
+def rebuild():
+    """Recreate the index of the current database from the items table,
+    e.g. for a database created before search was added."""
+    engine = db.get_engine(current_app)
+    _indexes.pop(engine, None)
+    if engine.dialect.name == 'sqlite' and has_fts5(engine):
+        _indexes[engine] = FTS5Index()
+    get_index(engine).rebuild(db.session())
+    db.session.commit()
+
+
+@event.listens_for(Session, 'after_flush')
+def index_flushed(session, flush_context):
+    ids = set(obj.id for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+              if isinstance(obj, Item))
+    reindex(ids, session)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_committed(session):
+    index = session.info.pop('search_index', None)
+    pending = session.info.pop('search_pending', None)
+    if index is not None and pending:
+        index.apply(pending)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop('search_index', None)
+    session.info.pop('search_pending', None)
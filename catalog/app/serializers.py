@@ -0,0 +1,126 @@
+from operator import attrgetter
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import configure_mappers, load_only
+from sqlalchemy.orm.interfaces import MANYTOONE
+from . import db
+from .exceptions import ValidationError
+from .models import Category, Item, User
+
+# how many parent ids go into one IN (...) when collecting related ids
+CHUNK_SIZE = 500
+# how many distinct ?fields= projections each serializer keeps around
+MAX_PROJECTIONS = 64
+
+
+class Serializer(object):
+    """Dump model instances to the same dictionaries as the model's
+    marshmallow schema in `schemas.py`.
+
+    The dump plan is read from the mapper once: plain columns are copied,
+    many-to-one relationships are written as the foreign key they are
+    stored in and one-to-many relationships as the list of related ids,
+    collected for a whole batch of rows with a single query.
+
+    Passing `fields` restricts the plan to those output fields; `options()`
+    then keeps every other column out of the SELECT."""
+
+    def __init__(self, model, fields=None):
+        mapper = inspect(model)
+        self.model = model
+        self.pk = mapper.get_property_by_column(mapper.primary_key[0]).key
+        self.projections = {}
+        names = []
+        keys = []
+        self.collections = []
+        for prop in mapper.column_attrs:
+            if not prop.columns[0].foreign_keys:
+                names.append(prop.key)
+                keys.append(prop.key)
+        for rel in mapper.relationships:
+            if rel.direction is MANYTOONE:
+                (column,) = rel.local_columns
+                names.append(rel.key)
+                keys.append(mapper.get_property_by_column(column).key)
+            else:
+                (column,) = rel.remote_side
+                self.collections.append((rel.key, column, rel.mapper.primary_key[0]))
+        if fields is not None:
+            keys = [key for name, key in zip(names, keys) if name in fields]
+            names = [name for name in names if name in fields]
+            self.collections = [c for c in self.collections if c[0] in fields]
+        self.fields = frozenset(names + [name for name, column, pk in self.collections])
+        self.names = tuple(names)
+        self.keys = tuple(keys)
+        if not keys:
+            self.getter = lambda obj: ()
+        elif len(keys) == 1:
+            getter = attrgetter(*keys)
+            self.getter = lambda obj: (getter(obj),)
+        else:
+            self.getter = attrgetter(*keys)
+
+    def only(self, fields):
+        """Return a serializer restricted to the output fields `fields`."""
+        fields = frozenset(fields)
+        if not fields:
+            raise ValidationError('Invalid fields: none requested')
+        unknown = fields - self.fields
+        if unknown:
+            raise ValidationError('Invalid fields: ' + ', '.join(sorted(unknown)))
+        projection = self.projections.get(fields)
+        if projection is None:
+            projection = Serializer(self.model, fields)
+            if len(self.projections) < MAX_PROJECTIONS:
+                self.projections[fields] = projection
+        return projection
+
+    def options(self):
+        """Query options that load only the columns this serializer reads."""
+        return [load_only(*(self.keys or (self.pk,)))]
+
+    def project(self, data):
+        """Restrict an already serialized row to this serializer's fields."""
+        return dict((name, value) for name, value in data.items() if name in self.fields)
+
+    def dump(self, obj):
+        return self.dump_many([obj])[0]
+
+    def dump_many(self, objs, collections=True):
+        names = self.names
+        getter = self.getter
+        output = [dict(zip(names, getter(obj))) for obj in objs]
+        if not collections:
+            return output
+        for name, column, pk in self.collections:
+            ids = [getattr(obj, self.pk) for obj in objs]
+            related = self.related_ids(column, pk, [id for id in ids if id is not None])
+            for data, id in zip(output, ids):
+                data[name] = related.get(id, [])
+        return output
+
+    @staticmethod
+    def related_ids(column, pk, ids):
+        """Map each parent id to the ids of the rows that point at it."""
+        related = {}
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            rows = db.session.query(column, pk).filter(column.in_(chunk)).order_by(pk)
+            for parent, id in rows:
+                related.setdefault(parent, []).append(id)
+        return related
+
+
+configure_mappers()
+user_serializer = Serializer(User)
+category_serializer = Serializer(Category)
+item_serializer = Serializer(Item)
+
+
+def for_request(serializer):
+    """Return `serializer` restricted to the `fields` query argument, if
+    the request has one."""
+    fields = request.args.get('fields')
+    if fields is None:
+        return serializer
+    return serializer.only(field.strip() for field in fields.split(',') if field.strip())
@@ -0,0 +1,201 @@
+import errno
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+
+def listen(bind, backlog=1024):
+    """Open the listening socket the workers share, for 'host:port'."""
+    host, port = bind.rsplit(':', 1)
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    listener = socket.socket(family, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host.strip('[]'), int(port)))
+    listener.listen(backlog)
+    # workers race for connections; the losers must not block in accept()
+    listener.setblocking(0)
+    return listener
+
+
+class PreforkWSGIServer(ThreadedWSGIServer):
+    """Werkzeug's threaded server on an inherited listening socket, one
+    thread per connection. Connections idle for `keepalive` seconds are
+    closed; with `keepalive` 0 every response closes its connection."""
+
+    daemon_threads = False
+
+    def __init__(self, listener, app, keepalive):
+        self.listener = listener
+        self.keepalive = keepalive
+        handler = type('RequestHandler', (WSGIRequestHandler,),
+                       {'protocol_version': 'HTTP/1.1' if keepalive else 'HTTP/1.0'})
+        host, port = listener.getsockname()[:2]
+        ThreadedWSGIServer.__init__(self, host, port, app, handler)
+
+    def server_bind(self):
+        self.socket.close()
+        self.socket = self.listener
+        self.server_address = self.socket.getsockname()
+        self.server_name = socket.getfqdn(self.server_address[0])
+        self.server_port = self.server_address[1]
+
+    def server_activate(self):
+        pass
+
+    def get_request(self):
+        con, info = self.socket.accept()
+        con.setblocking(1)
+        if self.keepalive:
+            con.settimeout(self.keepalive)
+        return con, info
+
+    def server_close(self):
+        # the master owns the listening socket
+        pass
+
+
+def serve_threaded(app, listener, keepalive, graceful_timeout):
+    server = PreforkWSGIServer(listener, app, keepalive)
+
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    server.serve_forever()
+    # let the requests in flight finish
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+
+
+def serve_gevent(app, listener, keepalive, graceful_timeout):
+    import gevent
+    from gevent.pywsgi import WSGIHandler, WSGIServer
+
+    class Handler(WSGIHandler):
+        def handle_one_response(self):
+            WSGIHandler.handle_one_response(self)
+            if not keepalive:
+                self.close_connection = True
+
+    class Server(WSGIServer):
+        def handle(self, sock, address):
+            if keepalive:
+                sock.settimeout(keepalive)
+            WSGIServer.handle(self, sock, address)
+
+    server = Server(listener, app, handler_class=Handler, log=None)
+    gevent.signal(signal.SIGTERM, server.stop, graceful_timeout)
+    server.serve_forever()
+
+
+MODES = {'prefork': serve_threaded, 'gevent': serve_gevent}
+
+
+class Master(object):
+    """Pre-fork process manager.
+
+    The master binds the socket and forks `workers` processes that each
+    build their own app with `factory` and serve the shared socket, so no
+    database connection or cache ever crosses a fork. Dead workers are
+    replaced. SIGHUP starts a new generation of workers, which reread the
+    configuration, and then retires the old one gracefully; SIGTERM and
+    SIGINT retire every worker and exit."""
+
+    def __init__(self, factory, mode='prefork', bind='127.0.0.1:5000', workers=None,
+                 keepalive=5, graceful_timeout=30):
+        self.factory = factory
+        self.mode = mode
+        self.serve = MODES[mode]
+        self.bind = bind
+        self.workers = workers or os.sysconf('SC_NPROCESSORS_ONLN')
+        self.keepalive = keepalive
+        self.graceful_timeout = graceful_timeout
+        self.children = {}
+        self.retiring = {}
+        self.reload = False
+        self.running = True
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return
+        status = 0
+        try:
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            # a Ctrl-C reaches the whole process group; the master handles it
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.serve(self.factory(), self.listener, self.keepalive, self.graceful_timeout)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            # skip the master's atexit handlers
+            os._exit(status)
+
+    def retire(self, pids):
+        for pid in pids:
+            self.retiring[pid] = time.time() + self.graceful_timeout
+            self.signal(pid, signal.SIGTERM)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            self.children.pop(pid, None)
+            self.retiring.pop(pid, None)
+
+    def on_hup(self, signum, frame):
+        self.reload = True
+
+    def on_stop(self, signum, frame):
+        self.running = False
+
+    def run(self):
+        self.listener = listen(self.bind)
+        signal.signal(signal.SIGHUP, self.on_hup)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        sys.stderr.write('serving on %s with %d %s workers\n' % (self.bind, self.workers, self.mode))
+        while self.running:
+            if self.reload:
+                self.reload = False
+                old = [pid for pid in self.children if pid not in self.retiring]
+                for _ in range(self.workers):
+                    self.spawn()
+                self.retire(old)
+            self.reap()
+            while len(self.children) - len(self.retiring) < self.workers:
+                self.spawn()
+            self.kill_overdue()
+            time.sleep(0.2)
+        self.retire([pid for pid in self.children if pid not in self.retiring])
+        while self.children:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
+        self.listener.close()
+
+    def kill_overdue(self):
+        now = time.time()
+        for pid, deadline in list(self.retiring.items()):
+            if deadline < now:
+                self.signal(pid, signal.SIGKILL)
@@ -0,0 +1,239 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from functools import wraps
+from io import BytesIO
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from werkzeug.wsgi import wrap_file
+from .streaming import wants_stream
+from .versions import lookup
+
+# the path of each snapshotted list, named after its version key
+VIEWS = {'categories': '/api/v1/categories', 'items': '/api/v1/items'}
+# set in the environ of the requests that build snapshots
+BUILDING = 'catalog.snapshot'
+
+
+class Snapshots(object):
+    """Files holding the responses of the bare category and item list
+    requests, with gzip variants, served instead of running the views.
+
+    A snapshot records the version of its list and is only served while
+    the versions table still holds it, so that writes made by processes
+    that do not share CATALOG_SNAPSHOT_DIR are seen too. Commits that
+    change a list also delete its manifest right away. The snapshot is
+    rebuilt in the background once no write came for
+    CATALOG_SNAPSHOT_DELAY seconds, or at the latest
+    CATALOG_SNAPSHOT_MAX_DELAY seconds after the first write. Until then,
+    and without a snapshot, requests use the views."""
+
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.thread = None
+        self.stopping = None
+        self.pid = None
+        self.due = None
+        self.deadline = None
+        self.url_root = None
+        self.builds = 0
+
+    def init_app(self, app):
+        # stop the builder serving the previous app
+        self.stop()
+        self.app = app
+        self.enabled = app.config.get('CATALOG_SNAPSHOT', False)
+        self.delay = app.config.get('CATALOG_SNAPSHOT_DELAY', 1.0)
+        self.max_delay = app.config.get('CATALOG_SNAPSHOT_MAX_DELAY', 10.0)
+        uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+        # one directory per database, so that apps never share snapshots
+        self.directory = app.config.get('CATALOG_SNAPSHOT_DIR') or os.path.join(
+            tempfile.gettempdir(), 'catalog_snapshots_' + hashlib.sha1(uri.encode('utf-8')).hexdigest()[:12])
+        with self.lock:
+            self.due = self.deadline = None
+            self.url_root = None
+
+    def path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def manifest(self, name):
+        """Return the manifest of the current snapshot of `name`, or None."""
+        try:
+            with open(self.path(name, '.manifest'), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def invalidate(self, names):
+        for name in names:
+            try:
+                os.remove(self.path(name, '.manifest'))
+            except OSError:
+                pass
+        self.schedule()
+
+    def schedule(self, url_root=None, debounce=True):
+        """Rebuild the snapshots after the writes settle. Reads only ask
+        for a rebuild, without postponing one already due."""
+        with self.lock:
+            if url_root is not None:
+                self.url_root = url_root
+            if self.url_root is None:
+                # nothing to build for until a request says where we are served
+                return
+            now = time.time()
+            if self.deadline is None:
+                self.deadline = now + self.max_delay
+            if self.due is None or debounce:
+                self.due = min(now + self.delay, self.deadline)
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.stopping = threading.Event()
+                self.thread = threading.Thread(target=self.run, args=(self.app, self.stopping))
+                self.thread.daemon = True
+                self.thread.start()
+            self.wakeup.notify()
+
+    def stop(self):
+        """Stop the builder and wait for the build it is running."""
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if self.stopping is not None:
+                self.stopping.set()
+                self.wakeup.notify_all()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def run(self, app, stopping):
+        while True:
+            with self.lock:
+                while not stopping.is_set() and (self.due is None or self.due > time.time()):
+                    self.wakeup.wait(None if self.due is None else self.due - time.time())
+                if stopping.is_set():
+                    return
+                self.due = self.deadline = None
+                url_root = self.url_root
+            with app.app_context():
+                from . import db
+                try:
+                    for name in VIEWS:
+                        self.build(app, name, url_root)
+                finally:
+                    db.session.remove()
+
+    def build(self, app, name, url_root):
+        """Render the bare list request of `name` and publish it, unless its
+        version moved meanwhile, in which case another build is due."""
+        before = lookup([name])
+        # straight from the primary, without the request hooks
+        with app.test_request_context(VIEWS[name], base_url=url_root.rstrip('/'),
+                                      headers={'Accept': 'application/json'},
+                                      environ_overrides={BUILDING: True, 'catalog.primary': True}):
+            rv = app.make_response(app.dispatch_request())
+            if rv.status_code != 200 or rv.is_streamed:
+                return
+            data = rv.get_data()
+            last_modified = rv.headers.get('Last-Modified')
+        etag = hashlib.sha1(data).hexdigest()
+        buf = BytesIO()
+        level = app.config.get('CATALOG_COMPRESS_LEVEL', 6)
+        with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+            f.write(data)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # files are named after their content and never change; the
+        # manifest switches from one version to the next atomically
+        for suffix, content in (('.json', data), ('.json.gz', buf.getvalue())):
+            self.write(self.path(name, '-' + etag + suffix), content)
+        self.write(self.path(name, '.manifest'), json.dumps(
+            {'etag': etag, 'url_root': url_root, 'last_modified': last_modified,
+             'version': before[name][0]}).encode('utf-8'))
+        # requests still sending the previous files keep them open
+        for path in glob.glob(self.path(name, '-*.json*')):
+            if not os.path.basename(path).startswith(name + '-' + etag + '.'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        if lookup([name]) != before:
+            self.invalidate([name])
+        else:
+            self.builds += 1
+
+    def write(self, path, content):
+        temporary = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(temporary, 'wb') as f:
+            f.write(content)
+        os.rename(temporary, path)
+
+    def serve(self, name):
+        """Return the response from the snapshot of `name`, or None if
+        there is none for this request."""
+        manifest = self.manifest(name)
+        if manifest is None or manifest['url_root'] != request.url_root or \
+                manifest['version'] != lookup([name])[name][0]:
+            self.schedule(request.url_root, debounce=False)
+            return None
+        gzipped = request.accept_encodings['gzip'] > 0
+        etag = manifest['etag'] + ('-gzip' if gzipped else '')
+        if etag in request.if_none_match:
+            rv = current_app.response_class(status=304)
+        else:
+            suffix = '.json.gz' if gzipped else '.json'
+            try:
+                f = open(self.path(name, '-' + manifest['etag'] + suffix), 'rb')
+            except IOError:
+                # replaced since the manifest was read
+                return None
+            rv = current_app.response_class(wrap_file(request.environ, f), mimetype='application/json',
+                                            direct_passthrough=True)
+            rv.content_length = os.fstat(f.fileno()).st_size
+            if gzipped:
+                rv.headers['Content-Encoding'] = 'gzip'
+        rv.set_etag(etag)
+        if manifest['last_modified']:
+            rv.headers['Last-Modified'] = manifest['last_modified']
+        rv.vary.add('Accept-Encoding')
+        return rv
+
+
+snapshots = Snapshots()
+
+
+def snapshot(name):
+    """Serve the bare list request of a view from its snapshot, if
+    snapshots are enabled and one is current."""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if snapshots.enabled and not request.args and not request.environ.get(BUILDING) \
+                    and not wants_stream():
+                rv = snapshots.serve(name)
+                if rv is not None:
+                    return rv
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    keys = session.info.pop('bumped_keys', None)
+    if keys and snapshots.enabled:
+        names = [name for name in VIEWS if name in keys]
+        if names:
+            snapshots.invalidate(names)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back(session):
+    session.info.pop('bumped_keys', None)
@@ -0,0 +1,54 @@
+import json
+from flask import Response, current_app, request, stream_with_context
+from .exceptions import ValidationError
+from .pagination import decode_cursor
+
+NDJSON = 'application/x-ndjson'
+
+
+def wants_stream():
+    """True if the client asked for a streamed NDJSON response."""
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def iter_batches(query, column, after=None, limit=None):
+    """Yield the rows of `query` in primary key order as lists of at most
+    CATALOG_STREAM_BATCH rows, one statement per list, so that neither the
+    driver nor the session ever holds the full result."""
+    batch = current_app.config.get('CATALOG_STREAM_BATCH', 1000)
+    sent = 0
+    while limit is None or sent < limit:
+        size = batch if limit is None else min(batch, limit - sent)
+        page = query
+        if after is not None:
+            page = page.filter(column > after)
+        rows = page.order_by(column).limit(size).all()
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        sent += len(rows)
+        after = getattr(rows[-1], column.key)
+
+
+def stream(query, column, dump_many):
+    """Stream every row of `query` as one JSON document per line. The
+    `after` and `limit` arguments are honoured but optional."""
+    after = request.args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    limit = request.args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValidationError('Invalid limit: ' + limit)
+        if limit < 1:
+            raise ValidationError('Invalid limit: must be at least 1')
+
+    def generate():
+        for rows in iter_batches(query, column, after, limit):
+            yield ''.join(json.dumps(data) + '\n' for data in dump_many(rows))
+    return Response(stream_with_context(generate()), mimetype=NDJSON)
@@ -0,0 +1,128 @@
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+from . import db
+from .models import Category, Item, User, Version
+
+
+def bump(keys, session=None):
+    """Increment the version of every key, within the current transaction.
+    Keys are updated in sorted order so that concurrent writers always
+    take their row locks in the same order."""
+    session = session or db.session
+    table = Version.__table__
+    now = datetime.utcnow()
+    # for the listeners that act once the transaction commits
+    session.info.setdefault('bumped_keys', set()).update(keys)
+    for key in sorted(set(keys)):
+        result = session.execute(table.update().where(table.c.key == key)
+                                 .values(version=table.c.version + 1, modified=now))
+        if result.rowcount == 0:
+            session.execute(table.insert().values(key=key, version=1, modified=now))
+
+
+def lookup(keys):
+    """Return a dict of key -> (version, modified) for the given keys.
+    Keys that were never bumped are reported as version 0."""
+    table = Version.__table__
+    rows = db.session.execute(table.select().where(table.c.key.in_(keys)))
+    found = dict((row.key, (row.version, row.modified)) for row in rows)
+    return dict((key, found.get(key, (0, None))) for key in keys)
+
+
+def current_versions(keys):
+    """lookup() for the current request, each key read once per request."""
+    known = request.environ.setdefault('catalog.versions', {})
+    missing = [key for key in keys if key not in known]
+    if missing:
+        known.update(lookup(missing))
+    return dict((key, known[key]) for key in keys)
+
+
+def changed_keys(session):
+    """Collect the version keys touched by the objects pending in a flush."""
+    keys = set()
+    for obj in session.new:
+        if isinstance(obj, Item):
+            keys.update(['items', 'categories', 'category:' + str(obj.cat_id)])
+        elif isinstance(obj, Category):
+            keys.update(['categories', 'category:' + str(obj.id)])
+        elif isinstance(obj, User):
+            keys.add('users')
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            keys.update(['items', 'categories', 'category:' + str(obj.cat_id)])
+        elif isinstance(obj, Category):
+            keys.update(['categories', 'category:' + str(obj.id)])
+        elif isinstance(obj, User):
+            keys.add('users')
+    for obj in session.dirty:
+        if not session.is_modified(obj):
+            continue
+        if isinstance(obj, Item):
+            keys.update(['items', 'category:' + str(obj.cat_id)])
+            history = get_history(obj, 'cat_id')
+            if history.deleted:
+                keys.add('categories')
+                keys.update('category:' + str(id) for id in history.deleted)
+        elif isinstance(obj, Category):
+            keys.update(['categories', 'category:' + str(obj.id)])
+        elif isinstance(obj, User):
+            keys.add('users')
+    return keys
+
+
+@event.listens_for(Session, 'after_flush')
+def bump_flushed(session, flush_context):
+    keys = changed_keys(session)
+    if keys:
+        bump(keys, session)
+
+
+def make_etag(versions):
+    """Derive a strong ETag from the versions of the keys a response
+    depends on and from everything in the request that shapes it."""
+    digest = hashlib.sha1()
+    for key in sorted(versions):
+        version, modified = versions[key]
+        digest.update(('%s=%d@%s;' % (key, version, modified)).encode('utf-8'))
+    digest.update(request.url.encode('utf-8'))
+    for header in ('Accept', 'Accept-Encoding'):
+        digest.update((header + '=' + (request.headers.get(header) or '') + ';').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def conditional(*keys):
+    """Answer conditional GETs for a view from version counters alone.
+
+    `keys` may reference the view arguments, e.g. 'category:{id}'. The
+    versions are read before the view runs, so a response is never
+    labelled with a version newer than its data."""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            versions = current_versions([key.format(**kwargs) for key in keys])
+            etag = g.etag = make_etag(versions)
+            modified = [v[1] for v in versions.values() if v[1] is not None]
+            modified = max(modified).replace(microsecond=0) if modified else None
+            if request.if_none_match:
+                not_modified = etag in request.if_none_match
+            else:
+                since = request.if_modified_since
+                not_modified = since is not None and modified is not None and modified <= since
+            if not_modified:
+                rv = current_app.response_class(status=304)
+            else:
+                rv = current_app.make_response(f(*args, **kwargs))
+                if rv.status_code != 200:
+                    return rv
+            rv.set_etag(etag)
+            if modified is not None:
+                rv.last_modified = modified
+            return rv
+        return wrapped
+    return decorator
@@ -0,0 +1,98 @@
+"""Generate a synthetic catalog for the benchmarks.
+
+Run from the catalog directory:
+
+    python -m benchmarks.catalog [--items N] [--categories N] [--database URI]
+
+The catalog is the same for the same arguments: items are spread evenly
+over the categories and their descriptions are drawn from a fixed
+vocabulary with a fixed seed, so search results are comparable between
+runs. Rows are written with multi-row Core inserts, bypassing the ORM.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from werkzeug.security import generate_password_hash
+from app import create_app, db
+from app.models import Category, Item, User
+from app.search import rebuild
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+CHUNK = 10000
+SEED = 1
+ADMIN_USERNAME = 'Admin'
+ADMIN_PASSWORD = 'Cookie stop snoring'
+WORDS = ('ball bat glove helmet racket net goal stick puck skate shoe sock shirt short '
+         'cap bag bottle towel pad guard board wheel rope mat wooden leather rubber '
+         'carbon light heavy red blue green black white youth adult pro training match '
+         'indoor outdoor summer winter classic').split()
+
+
+def database_uri(items):
+    return 'sqlite:////tmp/catalog_bench_%d.sqlite' % items
+
+
+def generate(items, categories):
+    """Replace the contents of the database with the admin user,
+    `categories` categories and `items` items."""
+    rng = random.Random(SEED)
+    db.drop_all()
+    db.create_all()
+    db.session.execute(User.__table__.insert(),
+                       [{'id': 1, 'username': ADMIN_USERNAME,
+                         'password_hash': generate_password_hash(ADMIN_PASSWORD)}])
+    for start in range(0, categories, CHUNK):
+        db.session.execute(Category.__table__.insert(), [
+            {'id': i + 1, 'name': 'Category %d' % i,
+             'item_count': items // categories + (1 if i < items % categories else 0)}
+            for i in range(start, min(start + CHUNK, categories))])
+    for start in range(0, items, CHUNK):
+        db.session.execute(Item.__table__.insert(), [
+            {'id': i + 1, 'cat_id': i % categories + 1,
+             'title': 'Item %d %s' % (i, rng.choice(WORDS)),
+             'description': ' '.join(rng.choice(WORDS) for _ in range(12))}
+            for i in range(start, min(start + CHUNK, items))])
+    db.session.commit()
+    rebuild()
+
+
+def is_generated(items, categories):
+    """True if the database already holds a catalog of this size."""
+    if not db.engine.has_table(Item.__tablename__):
+        return False
+    return Item.query.count() == items and Category.query.count() == categories \
+        and User.query.filter_by(username=ADMIN_USERNAME).count() == 1
+
+
+def open_catalog(items, categories, uri=None, regenerate=False):
+    """Create the app on the benchmark database and push its context,
+    generating the catalog first unless it is already there."""
+    app = create_app(os.environ.get('FLASK_CONFIG', 'testing'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri or database_uri(items)
+    ctx = app.app_context()
+    ctx.push()
+    if regenerate or not is_generated(items, categories):
+        start = time.time()
+        generate(items, categories)
+        print('generated %d items in %d categories in %.1fs' % (items, categories, time.time() - start))
+    return app, ctx
+
+
+def parse_size(value):
+    return SIZES.get(value.lower()) or int(value)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate a synthetic catalog.')
+    parser.add_argument('--items', type=parse_size, default=1000, help='1k, 100k, 1m or a number')
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--database', help='database URI, by default a SQLite file per size')
+    args = parser.parse_args(argv)
+    app, ctx = open_catalog(args.items, args.categories, args.database, regenerate=True)
+    ctx.pop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
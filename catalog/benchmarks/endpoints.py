@@ -0,0 +1,281 @@
+"""Benchmark every /api/v1 endpoint in process.
+
+Run from the catalog directory:
+
+    python -m benchmarks.endpoints [--items 1k] [--categories 100]
+        [--concurrency 1,4,16] [--requests 200] [--only NAME ...]
+        [--baseline FILE] [--save-baseline FILE] [--tolerance 0.2]
+
+The catalog is generated by `benchmarks.catalog` (and reused while it is
+unchanged). Requests go through `tests.test_client.TestClient`, so they
+run the full Flask dispatch without a network in between. Each endpoint
+is driven by as many threads as the concurrency level, and reports its
+throughput, p50 and p99 latency and the peak RSS of the process so far.
+
+With --baseline, every result is compared with the stored one and the
+run fails if throughput dropped or p99 latency grew by more than the
+tolerance.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from werkzeug.security import generate_password_hash
+from app import db
+from app.bulk import insert_items
+from app.models import Category, ImportJob, User
+from app.pagination import encode_cursor
+from tests.test_client import TestClient
+from .catalog import (ADMIN_PASSWORD, ADMIN_USERNAME, SEED, WORDS, open_catalog,
+                      parse_size)
+
+_names = itertools.count()
+
+
+def unique(prefix):
+    # unique across runs against the same database
+    return '%s %d-%d-%d' % (prefix, os.getpid(), int(time.time()), next(_names))
+
+
+class Endpoint(object):
+    """One endpoint to benchmark. `path` and `data` are values or
+    callables of the request's prepared argument, from `prepare(n)`."""
+
+    def __init__(self, name, method, path, data=None, prepare=None, client='token'):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.prepare = prepare
+        self.client = client
+
+    def request(self, arg):
+        path = self.path(arg) if callable(self.path) else self.path
+        data = self.data(arg) if callable(self.data) else self.data
+        return path, data
+
+
+class StreamClient(object):
+    """Sends the requests whose body is not one JSON document, exports
+    and uploads, through the WSGI stack, reading the whole response."""
+
+    def __init__(self, app, auth):
+        self.client = app.test_client()
+        self.auth = auth
+
+    def send(self, url, method='GET', data=None):
+        rv = self.client.open(url, method=method, data=data, headers={'Authorization': self.auth})
+        return rv, rv.data
+
+
+def prepare_categories(n):
+    rows = [{'name': unique('Bench category')} for _ in range(n)]
+    db.session.execute(Category.__table__.insert(), rows)
+    db.session.commit()
+    names = [row['name'] for row in rows]
+    return [id for (id,) in db.session.query(Category.id).filter(Category.name.in_(names))]
+
+
+def prepare_items(n):
+    ids = insert_items([{'cat_id': 1, 'title': unique('Bench item'), 'description': 'Bench'}
+                        for _ in range(n)])
+    db.session.commit()
+    return ids
+
+
+def prepare_users(n):
+    password_hash = generate_password_hash('bench')
+    rows = [{'username': unique('bench'), 'password_hash': password_hash} for _ in range(n)]
+    db.session.execute(User.__table__.insert(), rows)
+    db.session.commit()
+    names = [row['username'] for row in rows]
+    return [id for (id,) in db.session.query(User.id).filter(User.username.in_(names))]
+
+
+def prepare_imports(n):
+    rows = [{'status': 'done', 'format': 'ndjson', 'path': unique('bench.ndjson')} for _ in range(n)]
+    db.session.execute(ImportJob.__table__.insert(), rows)
+    db.session.commit()
+    paths = [row['path'] for row in rows]
+    return [id for (id,) in db.session.query(ImportJob.id).filter(ImportJob.path.in_(paths))]
+
+
+def import_body(arg):
+    # ten new items, one JSON document per line
+    return ''.join(json.dumps({'title': unique('Bench item'), 'description': 'Bench',
+                               'category': 1}) + '\n' for _ in range(10))
+
+
+def endpoints(items, categories):
+    rng = random.Random(SEED)
+
+    def item():
+        return rng.randint(1, items)
+
+    def category():
+        return rng.randint(1, categories)
+
+    return [
+        Endpoint('categories.list', 'GET', '/api/v1/categories'),
+        Endpoint('categories.stats', 'GET', '/api/v1/categories/stats'),
+        Endpoint('categories.get', 'GET', lambda arg: '/api/v1/categories/%d' % category()),
+        Endpoint('categories.items', 'GET', lambda arg: '/api/v1/categories/%d/items' % category()),
+        Endpoint('items.list', 'GET', lambda arg: '/api/v1/items?after=' + encode_cursor(item())),
+        Endpoint('items.search', 'GET', lambda arg: '/api/v1/items/search?q=' + rng.choice(WORDS)),
+        Endpoint('items.get', 'GET', lambda arg: '/api/v1/items/%d' % item()),
+        Endpoint('users.list', 'GET', '/api/v1/users'),
+        Endpoint('users.get', 'GET', '/api/v1/users/1'),
+        Endpoint('changes.list', 'GET', '/api/v1/changes'),
+        Endpoint('export.categories', 'GET', '/api/v1/export?entity=categories', client='stream'),
+        Endpoint('export.csv', 'GET', '/api/v1/export?entity=categories&format=csv&gzip=1',
+                 client='stream'),
+        Endpoint('imports.get', 'GET', lambda id: '/api/v1/imports/%d' % id, prepare=prepare_imports),
+        Endpoint('internal.cache', 'GET', '/api/v1/_internal/cache'),
+        Endpoint('internal.pool', 'GET', '/api/v1/_internal/pool'),
+        Endpoint('categories.create', 'POST', '/api/v1/categories',
+                 lambda arg: {'name': unique('Bench category')}),
+        Endpoint('categories.edit', 'PUT', lambda id: '/api/v1/categories/%d' % id,
+                 lambda id: {'name': unique('Bench category')}, prepare_categories),
+        Endpoint('categories.delete', 'DELETE', lambda id: '/api/v1/categories/%d' % id,
+                 prepare=prepare_categories),
+        Endpoint('items.create', 'POST', lambda arg: '/api/v1/categories/%d/items' % category(),
+                 lambda arg: {'title': unique('Bench item'), 'description': 'Bench'}),
+        Endpoint('items.batch', 'POST', lambda arg: '/api/v1/categories/%d/items/batch' % category(),
+                 lambda arg: [{'title': unique('Bench item'), 'description': 'Bench'}
+                              for _ in range(10)]),
+        Endpoint('items.edit', 'PUT', lambda arg: '/api/v1/items/%d' % item(),
+                 lambda arg: {'description': unique('Edited')}),
+        Endpoint('items.delete', 'DELETE', lambda id: '/api/v1/items/%d' % id,
+                 prepare=prepare_items),
+        Endpoint('items.bulk_edit', 'PUT',
+                 lambda arg: '/api/v1/items?ids=' + ','.join(str(item()) for _ in range(10)),
+                 lambda arg: {'description': unique('Edited')}),
+        Endpoint('items.bulk_delete', 'DELETE', lambda id: '/api/v1/items?ids=%d' % id,
+                 prepare=prepare_items),
+        Endpoint('imports.create', 'POST', '/api/v1/imports?format=ndjson', import_body,
+                 client='stream'),
+        Endpoint('users.create', 'POST', '/api/v1/users',
+                 lambda arg: {'username': unique('bench'), 'password': 'bench'}),
+        Endpoint('users.bulk', 'POST', '/api/v1/users/bulk',
+                 lambda arg: [{'username': unique('bench'), 'password': 'bench'} for _ in range(10)],
+                 client='password'),
+        Endpoint('users.edit', 'PUT', lambda id: '/api/v1/users/%d' % id,
+                 lambda id: {'username': unique('bench')}, prepare_users, client='password'),
+        Endpoint('users.delete', 'DELETE', lambda id: '/api/v1/users/%d' % id,
+                 prepare=prepare_users, client='password'),
+    ]
+
+
+def percentile(values, fraction):
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def peak_rss():
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+
+def run(clients, endpoint, concurrency, requests):
+    args = endpoint.prepare(requests) if endpoint.prepare else [None] * requests
+    db.session.remove()
+    client = clients[endpoint.client]
+    latencies = []
+    errors = []
+
+    def worker(args):
+        for arg in args:
+            path, data = endpoint.request(arg)
+            start = time.time()
+            try:
+                rv, body = client.send(path, endpoint.method, data)
+                if rv.status_code >= 400:
+                    errors.append(rv.status_code)
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.time() - start)
+
+    threads = [threading.Thread(target=worker, args=(args[i::concurrency],))
+               for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {'requests': requests, 'errors': len(errors),
+            'throughput': requests / elapsed,
+            'p50': percentile(latencies, 0.5) * 1000, 'p99': percentile(latencies, 0.99) * 1000,
+            'peak_rss': peak_rss()}
+
+
+def compare(result, baseline, tolerance):
+    """Return the regressions of `result` against `baseline`."""
+    regressions = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        regressions.append('throughput %.0f/s < %.0f/s' % (result['throughput'], baseline['throughput']))
+    if result['p99'] > baseline['p99'] * (1 + tolerance):
+        regressions.append('p99 %.1fms > %.1fms' % (result['p99'], baseline['p99']))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the /api/v1 endpoints.')
+    parser.add_argument('--items', type=parse_size, default=1000, help='1k, 100k, 1m or a number')
+    parser.add_argument('--categories', type=int, default=100)
+    parser.add_argument('--database', help='database URI, by default a SQLite file per size')
+    parser.add_argument('--concurrency', default='1,4,16', help='comma-separated thread counts')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and level')
+    parser.add_argument('--only', nargs='*', help='endpoint names, e.g. items.list')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    app, ctx = open_catalog(args.items, args.categories, args.database)
+    token = User.query.filter_by(username=ADMIN_USERNAME).one().generate_auth_token(expires_in=86400)
+    clients = {'token': TestClient(app, token, ''),
+               'password': TestClient(app, ADMIN_USERNAME, ADMIN_PASSWORD)}
+    clients['stream'] = StreamClient(app, clients['token'].auth)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressed = False
+    print('%-20s %5s %10s %9s %9s %9s %7s' % ('endpoint', 'conc', 'req/s', 'p50 ms', 'p99 ms',
+                                               'rss MB', 'errors'))
+    for endpoint in endpoints(args.items, args.categories):
+        if args.only and endpoint.name not in args.only:
+            continue
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            key = '%s@%d' % (endpoint.name, concurrency)
+            result = results[key] = run(clients, endpoint, concurrency, args.requests)
+            line = '%-20s %5d %10.1f %9.2f %9.2f %9.1f %7d' % (
+                endpoint.name, concurrency, result['throughput'], result['p50'], result['p99'],
+                result['peak_rss'], result['errors'])
+            if key in baseline:
+                regressions = compare(result, baseline[key], args.tolerance)
+                regressed = regressed or bool(regressions)
+                line += '  ' + ('REGRESSED: ' + ', '.join(regressions) if regressions else
+                                '%+.0f%% req/s' % (100.0 * result['throughput'] /
+                                                    baseline[key]['throughput'] - 100))
+            print(line)
+            sys.stdout.flush()
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    ctx.pop()
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,68 @@
+"""Compare the precompiled serializers with the marshmallow schemas.
+
+Run from the catalog directory:
+
+    python -m benchmarks.serializers [rows ...]
+
+Each run fills an in-memory SQLite database, loads every row and dumps
+it with both implementations, checking that their output is identical.
+"""
+import os
+import sys
+import time
+from app import create_app, db
+from app.models import Category, Item
+from app.schemas import CategorySchema, ItemSchema
+from app.serializers import category_serializer, item_serializer
+
+CATEGORIES = 100
+REPEAT = 3
+
+
+def populate(rows):
+    db.drop_all()
+    db.create_all()
+    db.session.execute(Category.__table__.insert(),
+                       [{'id': i + 1, 'name': 'Category %d' % i} for i in range(CATEGORIES)])
+    db.session.execute(Item.__table__.insert(),
+                       [{'id': i + 1, 'cat_id': i % CATEGORIES + 1, 'title': 'Item %d' % i,
+                         'description': 'Description of item %d' % i} for i in range(rows)])
+    db.session.commit()
+
+
+def best_of(fn):
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        output = fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, output
+
+
+def compare(name, rows, schema, serializer):
+    marshmallow_time, expected = best_of(lambda: schema(many=True).dump(rows).data)
+    plan_time, output = best_of(lambda: serializer.dump_many(rows))
+    if output != expected:
+        raise AssertionError(name + ': serializer output differs from the schema')
+    print('%-10s %8d rows  marshmallow %8.3fs  serializer %8.3fs  speedup %5.1fx' % (
+        name, len(rows), marshmallow_time, plan_time, marshmallow_time / plan_time))
+
+
+def main(argv):
+    sizes = [int(arg) for arg in argv] or [10000, 100000]
+    app = create_app(os.environ.get('FLASK_CONFIG', 'testing'))
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        for size in sizes:
+            populate(size)
+            items = Item.query.order_by(Item.id).all()
+            compare('items', items, ItemSchema, item_serializer)
+            categories = Category.query.order_by(Category.id).all()
+            compare('categories', categories, CategorySchema, category_serializer)
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,5 @@
+DEBUG = False
+TESTING = True
+SECRET_KEY = 'top-secret!'
+SERVER_NAME = 'example.com'
+SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/catalog_test.sqlite'
@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+from app import create_app
+from app.exceptions import ValidationError
+from app.export import ENTITIES, FORMATS, export, parse_after, parse_entities
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Export every category and item.')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+    parser.add_argument('--entity', default=','.join(ENTITIES),
+                        help='comma-separated tables to export, categories,items by default')
+    parser.add_argument('--after', help='resume after this row, <entity>:<id>')
+    parser.add_argument('--gzip', action='store_true', help='gzip the output')
+    parser.add_argument('--output', help='file to write, standard output by default; '
+                                         'with --after it is appended to')
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+    app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+    position = {}
+
+    def progress(entity, id):
+        position['after'] = '%s:%d' % (entity, id)
+
+    with app.app_context():
+        try:
+            entities = parse_entities(args.entity)
+            after = parse_after(args.after)
+        except ValidationError as e:
+            sys.stderr.write(e.args[0] + '\n')
+            return 2
+        out = open(args.output, 'ab' if args.after else 'wb') if args.output else \
+            getattr(sys.stdout, 'buffer', sys.stdout)
+        try:
+            for chunk in export(args.format, entities, after, args.gzip, progress):
+                out.write(chunk)
+        except BaseException:
+            if 'after' in position:
+                sys.stderr.write('export interrupted, resume with --after %s\n' % position['after'])
+            raise
+        finally:
+            if args.output:
+                out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,9 +1,34 @@
+import argparse
 import os
-from app import create_app, db
-from app.models import User
+import sys
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Run the catalog.')
+    parser.add_argument('--mode', choices=['dev', 'prefork', 'gevent'], default='dev',
+                        help='dev: the Werkzeug development server (default); '
+                             'prefork: one process per worker, one thread per connection; '
+                             'gevent: one process per worker, one greenlet per connection')
+    parser.add_argument('--bind', default='127.0.0.1:5000', help='host:port to listen on')
+    parser.add_argument('--workers', type=int, help='worker processes, one per core by default')
+    parser.add_argument('--keepalive', type=float, default=5,
+                        help='seconds an idle connection is kept open, 0 to close after each response')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds a retiring worker may take to finish its requests')
+    return parser.parse_args(argv)
+
 
 if __name__ == '__main__':
-    app = create_app(os.environ.get('FLASK_CONFIG', 'development'))
+    args = parse_args(sys.argv[1:])
+    if args.mode == 'gevent':
+        # before anything creates sockets, threads or locks
+        from gevent import monkey
+        monkey.patch_all()
+    from app import create_app, db
+    from app.models import User
+
+    config = os.environ.get('FLASK_CONFIG', 'development')
+    app = create_app(config)
     with app.app_context():
         db.create_all()
         # create a development user
@@ -12,4 +37,12 @@ if __name__ == '__main__':
             u.set_password('Cookie stop snoring')
             db.session.add(u)
             db.session.commit()
-    app.run()
+    if args.mode == 'dev':
+        app.run()
+    else:
+        from app.serving import Master
+        # the workers build their own apps; no connection may cross the fork
+        with app.app_context():
+            db.engine.dispose()
+        Master(lambda: create_app(config), args.mode, args.bind, args.workers,
+               args.keepalive, args.graceful_timeout).run()
@@ -1,7 +1,28 @@
 #!/usr/bin/env python
-import coverage
+import argparse
+import os
+import subprocess
+import sys
 import unittest
 from tests import suite
+
+parser = argparse.ArgumentParser(description='Run the tests.')
+parser.add_argument('--parallel', type=int, default=0, metavar='N',
+                    help='split the tests over N worker processes, without coverage')
+parser.add_argument('--database', default='sqlite:////tmp/catalog_test_{worker}.sqlite',
+                    help='database URI for each worker, {worker} is its number')
+args = parser.parse_args()
+
+if args.parallel:
+    names = [test.id() for test in suite]
+    workers = []
+    for worker in range(args.parallel):
+        env = dict(os.environ, CATALOG_TEST_DATABASE_URI=args.database.format(worker=worker))
+        workers.append(subprocess.Popen([sys.executable, '-m', 'unittest'] +
+                                        names[worker::args.parallel], env=env))
+    sys.exit(max(worker.wait() for worker in workers))
+
+import coverage
 COV = coverage.coverage(branch=True, include='app/*')
 COV.start()
 
@@ -1,30 +1,150 @@
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
 import unittest
-from werkzeug.exceptions import NotFound, BadRequest, MethodNotAllowed
+import gzip
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+from json import dumps, loads
+from flask import g
+from flask.ext.sqlalchemy import _SignallingSession
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError, TimeoutError
+from sqlalchemy.orm import Session, scoped_session
+from sqlalchemy.pool import QueuePool
+from werkzeug.exceptions import NotFound, BadRequest, MethodNotAllowed, ServiceUnavailable
 from app import create_app, db, ValidationError
-from app.models import User
+from app import pagination, search
+from app.cache import entities, tokens
+from app.compression import payloads
+from app.counts import recount
+from app.groupcommit import commits
+from app import imports
+from app.imports import importer
+from app.metrics import metrics
+from app.pool import stats, timed
+from app.replicas import replicas
+from app.models import Category, Change, Item, User, Version
+from app.schemas import CategorySchema, ItemSchema, UserSchema
+from app.search import FTS5Index, MemoryIndex, get_index, rebuild
+from app.serializers import category_serializer, item_serializer, user_serializer
+from app.snapshots import snapshots
 from .test_client import TestClient
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+
+def committed(test):
+    """Run `test` against the real database instead of inside a rolled
+    back transaction, for tests that write from other threads."""
+    test.committed = True
+    return test
+
+
+class ConnectionSession(_SignallingSession):
+    """Session joined to the test's connection. What the app commits is
+    only released to a SAVEPOINT, and a new one is started right away."""
+
+    def __init__(self, db, connection, **options):
+        self.app = db.get_app()
+        self._model_changes = {}
+        Session.__init__(self, autocommit=False, autoflush=False, bind=connection, **options)
+        event.listen(self, 'after_transaction_end', self.restart_savepoint)
+        self.begin_nested()
+
+    def restart_savepoint(self, session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            self.expire_all()
+            self.begin_nested()
 
 
 class TestAPI(unittest.TestCase):
     default_username = 'Admin'
     default_password = 'Cookie stop snoring'
 
-    def setUp(self):
-        self.app = create_app('testing')
-        self.ctx = self.app.app_context()
-        self.ctx.push()
+    @classmethod
+    def setUpClass(cls):
+        # the app and the schema are created once; each test rolls back
+        cls.app = create_app('testing')
+        if os.environ.get('CATALOG_TEST_DATABASE_URI'):
+            cls.app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['CATALOG_TEST_DATABASE_URI']
+        cls.config = dict(cls.app.config)
+        cls.ctx = cls.app.app_context()
+        cls.ctx.push()
         db.drop_all()
         db.create_all()
-        u = User(username=self.default_username)
-        u.set_password(self.default_password)
+        u = User(username=cls.default_username)
+        u.set_password(cls.default_password)
         db.session.add(u)
         db.session.commit()
-        self.client = TestClient(self.app, u.generate_auth_token(), '')
+        cls.admin = {'id': u.id, 'username': u.username, 'password_hash': u.password_hash}
+        cls.token = u.generate_auth_token()
+        cls.db_session = db.session
+        db.session.remove()
 
-    def tearDown(self):
+    @classmethod
+    def tearDownClass(cls):
         db.session.remove()
         db.drop_all()
-        self.ctx.pop()
+        cls.ctx.pop()
+
+    def setUp(self):
+        self.app.config.clear()
+        self.app.config.update(self.config)
+        for extension in (entities, tokens, payloads, commits, replicas, importer, snapshots):
+            extension.init_app(self.app)
+        metrics.reset()
+        search._indexes.clear()
+        pagination._counts.clear()
+        self.committed = getattr(getattr(self, self._testMethodName), 'committed', False)
+        if not self.committed:
+            self.begin()
+        self.client = TestClient(self.app, self.token, '')
+
+    def tearDown(self):
+        db.session.remove()
+        if self.committed:
+            self.clean()
+        else:
+            self.rollback()
+
+    def begin(self):
+        """Open the outer transaction the test runs in."""
+        self.connection = db.engine.connect()
+        self.dbapi_connection = self.connection.connection.connection
+        if db.engine.dialect.name == 'sqlite':
+            # pysqlite would commit before every SAVEPOINT; take over BEGIN
+            self.isolation_level = self.dbapi_connection.isolation_level
+            self.dbapi_connection.isolation_level = None
+            self.transaction = self.connection.begin()
+            self.connection.execute('BEGIN')
+        else:
+            self.transaction = self.connection.begin()
+        db.session = scoped_session(lambda: ConnectionSession(db, self.connection))
+
+    def rollback(self):
+        self.transaction.rollback()
+        if db.engine.dialect.name == 'sqlite':
+            self.dbapi_connection.isolation_level = self.isolation_level
+        self.connection.close()
+        db.session = self.db_session
+
+    def clean(self):
+        """Empty the tables a committed test wrote to, keeping the admin."""
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.execute(User.__table__.insert(), [self.admin])
+        db.session.commit()
+        rebuild()
+        db.session.remove()
 
     def testCategories(self):
         # Get empty list of categories
@@ -415,6 +535,1190 @@ class TestAPI(unittest.TestCase):
         self.assertTrue(rv.status_code == 200)
         self.assertTrue(len(json['Baseball items']) == 1)
 
+    def testPagination(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+        for title in ['Bat', 'Glove', 'Helmet', 'Base', 'Cap']:
+            rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                        data={'title': title, 'description': title})
+            self.assertTrue(rv.status_code == 201)
+
+        # Walk the item list two at a time
+        titles = []
+        url = '/api/v1/items?limit=2&count=1'
+        while url is not None:
+            rv, json = self.client.get(url)
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(len(json['items']) <= 2)
+            self.assertTrue(json['total'] == 5)
+            titles += [item['title'] for item in json['items']]
+            url = json['next']
+        self.assertTrue(titles == ['Bat', 'Glove', 'Helmet', 'Base', 'Cap'])
+
+        # Category items are paginated the same way
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id) + '/items?limit=3')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['Baseball items']) == 3)
+        rv, json = self.client.get(json['next'])
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['Baseball items']) == 2)
+        self.assertTrue(json['next'] is None)
+        rv, json = self.client.get('/api/v1/categories?limit=1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(json['categories']) == 1)
+        self.assertTrue(json['next'] is None)
+
+        # Bad paging arguments
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items?limit=0')
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items?limit=ten')
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items?after=garbage')
+
+    def testStreaming(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+        for title in ['Bat', 'Glove', 'Helmet', 'Base', 'Cap']:
+            rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                        data={'title': title, 'description': title})
+            self.assertTrue(rv.status_code == 201)
+
+        # Rows arrive one JSON document per line, fetched a couple at a time
+        self.app.config['CATALOG_STREAM_BATCH'] = 2
+        client = self.app.test_client()
+        rv = client.get('/api/v1/items?stream=1')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'application/x-ndjson')
+        items = [loads(line) for line in rv.data.decode('utf-8').splitlines()]
+        self.assertTrue([item['title'] for item in items] == ['Bat', 'Glove', 'Helmet', 'Base', 'Cap'])
+        rv = client.get('/api/v1/categories/' + str(cat_id) + '/items?limit=3',
+                        headers={'Accept': 'application/x-ndjson'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(len(rv.data.decode('utf-8').splitlines()) == 3)
+        rv = client.get('/api/v1/categories', headers={'Accept': 'application/x-ndjson'})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(loads(rv.data.decode('utf-8'))['name'] == 'Baseball')
+
+    def testSerializers(self):
+        # The precompiled serializers must agree with the marshmallow schemas
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Soccer'})
+        self.assertTrue(rv.status_code == 201)
+        for title in ['Bat', 'Glove', 'Helmet']:
+            rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                        data={'title': title, 'description': title})
+            self.assertTrue(rv.status_code == 201)
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Cap', 'description': None})
+        self.assertTrue(rv.status_code == 201)
+
+        for serializer, schema, model in [(user_serializer, UserSchema, User),
+                                          (category_serializer, CategorySchema, Category),
+                                          (item_serializer, ItemSchema, Item)]:
+            rows = model.query.order_by(model.id).all()
+            self.assertTrue(serializer.dump_many(rows) == schema(many=True).dump(rows).data)
+            for row in rows:
+                self.assertTrue(serializer.dump(row) == schema().dump(row).data)
+
+    def testConditional(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Soccer'})
+        self.assertTrue(rv.status_code == 201)
+        other_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Hits the ball'})
+        self.assertTrue(rv.status_code == 201)
+        item_id = int(json['id'])
+
+        client = self.app.test_client()
+        urls = ['/api/v1/items', '/api/v1/items/' + str(item_id), '/api/v1/categories',
+                '/api/v1/categories/' + str(cat_id), '/api/v1/categories/' + str(cat_id) + '/items',
+                '/api/v1/categories/' + str(other_id) + '/items']
+        etags = {}
+        for url in urls:
+            rv = client.get(url)
+            self.assertTrue(rv.status_code == 200)
+            self.assertTrue(rv.headers.get('Last-Modified') is not None)
+            etags[url] = rv.headers['ETag']
+            # Unchanged data is answered with 304 and no body
+            rv = client.get(url, headers={'If-None-Match': etags[url]})
+            self.assertTrue(rv.status_code == 304)
+            self.assertTrue(rv.data == b'')
+        # Different representations get different tags
+        rv = client.get('/api/v1/items?limit=1')
+        self.assertTrue(rv.headers['ETag'] != etags['/api/v1/items'])
+
+        # Adding an item changes every view of it but not the other category
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Glove', 'description': 'Catches the ball'})
+        self.assertTrue(rv.status_code == 201)
+        for url in urls:
+            rv = client.get(url, headers={'If-None-Match': etags[url]})
+            if url == '/api/v1/categories/' + str(other_id) + '/items':
+                self.assertTrue(rv.status_code == 304)
+            else:
+                self.assertTrue(rv.status_code == 200)
+                etags[url] = rv.headers['ETag']
+
+        # Moving an item changes both categories
+        rv, json = self.client.put('/api/v1/items/' + str(item_id), data={'category': other_id})
+        self.assertTrue(rv.status_code == 200)
+        for url in urls[-2:]:
+            rv = client.get(url, headers={'If-None-Match': etags[url]})
+            self.assertTrue(rv.status_code == 200)
+            etags[url] = rv.headers['ETag']
+
+        # Renaming a category changes its item list, deleting an item changes the others
+        rv, json = self.client.put('/api/v1/categories/' + str(cat_id), data={'name': 'Baseball gear'})
+        self.assertTrue(rv.status_code == 200)
+        url = '/api/v1/categories/' + str(cat_id) + '/items'
+        rv = client.get(url, headers={'If-None-Match': etags[url]})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.delete('/api/v1/items/' + str(item_id))
+        self.assertTrue(rv.status_code == 204)
+        rv = client.get('/api/v1/items', headers={'If-None-Match': etags['/api/v1/items']})
+        self.assertTrue(rv.status_code == 200)
+
+    def testEntityCache(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Hits the ball'})
+        self.assertTrue(rv.status_code == 201)
+        item_id = int(json['id'])
+
+        # Repeated lookups are served from the cache
+        rv, stats = self.client.get('/api/v1/_internal/cache')
+        rv, json = self.client.get('/api/v1/items/' + str(item_id))
+        self.assertTrue(json['title'] == 'Bat')
+        rv, json = self.client.get('/api/v1/items/' + str(item_id))
+        self.assertTrue(json['title'] == 'Bat')
+        rv, json = self.client.get('/api/v1/_internal/cache')
+        self.assertTrue(json['misses'] == stats['misses'] + 1)
+        self.assertTrue(json['hits'] == stats['hits'] + 1)
+
+        # Writes invalidate the item and the category listing its id
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id))
+        self.assertTrue(json['items'] == [item_id])
+        rv, json = self.client.put('/api/v1/items/' + str(item_id), data={'title': 'Glove'})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = self.client.get('/api/v1/items/' + str(item_id))
+        self.assertTrue(json['title'] == 'Glove')
+        rv, json = self.client.delete('/api/v1/items/' + str(item_id))
+        self.assertTrue(rv.status_code == 204)
+        self.assertRaises(NotFound, self.client.get, '/api/v1/items/' + str(item_id))
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id))
+        self.assertTrue(json['items'] == [])
+
+        # Writes of other processes show through their version bump
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Hits the ball'})
+        item_id = int(json['id'])
+        rv, json = self.client.get('/api/v1/items/' + str(item_id))
+        etag = rv.headers['ETag']
+        items, versions = Item.__table__, Version.__table__
+        db.session.execute(items.update().where(items.c.id == item_id).values(title='Helmet'))
+        db.session.execute(versions.update().where(versions.c.key == 'items')
+                           .values(version=versions.c.version + 1))
+        db.session.commit()
+        rv, json = self.client.get('/api/v1/items/' + str(item_id))
+        self.assertTrue(json['title'] == 'Helmet' and rv.headers['ETag'] != etag)
+
+        # A remembered 404 is forgotten once the row is created
+        self.assertRaises(NotFound, self.client.get, '/api/v1/users/2')
+        self.assertRaises(NotFound, self.client.get, '/api/v1/users/2')
+        rv, json = self.client.post('/api/v1/users', data={'username': 'patrick', 'password': 'backend'})
+        self.assertTrue(rv.status_code == 201)
+        self.assertTrue(json['id'] == 2)
+        rv, json = self.client.get('/api/v1/users/2')
+        self.assertTrue(json['username'] == 'patrick')
+
+        # The cache stays within its size
+        entities.maxsize = 1
+        self.client.get('/api/v1/users/1')
+        self.client.get('/api/v1/users/2')
+        rv, json = self.client.get('/api/v1/_internal/cache')
+        self.assertTrue(json['size'] == 1)
+        self.assertTrue(json['evictions'] >= 1)
+
+    def testTokenCache(self):
+        rv, json = self.client.post('/api/v1/users', data={'username': 'patrick', 'password': 'backend'})
+        self.assertTrue(rv.status_code == 201)
+        user_id = int(json['id'])
+        token_client = TestClient(self.app, json['token'], '')
+        rv, json = token_client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+
+        # Once verified, a token no longer costs a user lookup
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rv, json = token_client.post('/api/v1/categories', data={'name': 'Soccer'})
+            self.assertTrue(rv.status_code == 201)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertFalse([s for s in statements if s.startswith('SELECT') and 'FROM users' in s])
+
+        # Deleting the user revokes the cached token
+        admin_client = TestClient(self.app, self.default_username, self.default_password)
+        rv, json = admin_client.delete('/api/v1/users/' + str(user_id))
+        self.assertTrue(rv.status_code == 204)
+        rv, json = token_client.post('/api/v1/categories', data={'name': 'Hockey'})
+        self.assertTrue(rv.status_code == 401)
+
+        # Users changed by other processes are looked up again once the entry expires
+        self.app.config['CATALOG_TOKEN_CACHE_TTL'] = 0.5
+        tokens.init_app(self.app)
+        rv, json = self.client.post('/api/v1/users', data={'username': 'alex', 'password': 'jcole'})
+        user_id = int(json['id'])
+        token_client = TestClient(self.app, json['token'], '')
+        rv, json = token_client.post('/api/v1/categories', data={'name': 'Hockey'})
+        self.assertTrue(rv.status_code == 201)
+        db.session.execute(User.__table__.delete().where(User.__table__.c.id == user_id))
+        db.session.commit()
+        rv, json = token_client.post('/api/v1/categories', data={'name': 'Tennis'})
+        self.assertTrue(rv.status_code == 201)
+        time.sleep(0.6)
+        rv, json = token_client.post('/api/v1/categories', data={'name': 'Golf'})
+        self.assertTrue(rv.status_code == 401)
+
+    def testBulkUsers(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 2
+        admin_client = TestClient(self.app, self.default_username, self.default_password)
+        rows = [{'username': 'patrick', 'password': 'backend'},
+                {'username': 'alex', 'password': 'jcole'},
+                {'username': 'patrick', 'password': 'again'},
+                {'username': 'Admin', 'password': 'taken'},
+                {'username': 'soumil'},
+                {'username': 7, 'password': 'number'},
+                {'username': 'soumil', 'password': ['not', 'a', 'string']},
+                'soumil']
+        rv, json = admin_client.post('/api/v1/users/bulk', data=rows)
+        self.assertTrue(rv.status_code == 201)
+        results = json['users']
+        self.assertTrue(len(results) == 8)
+        self.assertTrue('id' in results[0] and 'id' in results[1])
+        self.assertTrue(['error' in result for result in results] == [False, False] + [True] * 6)
+        self.assertTrue(results[5]['error'] == 'Invalid user: username must be a non-empty string')
+        self.assertTrue(results[6]['error'] == 'Invalid user: password must be a string')
+
+        # A username taken between the check and the commit is a conflict
+        def steal(session):
+            session.execute(User.__table__.insert().values(username='late', password_hash='x'))
+        event.listen(Session, 'before_commit', steal, once=True)
+        rv, json = admin_client.post('/api/v1/users/bulk', data=[{'username': 'late', 'password': 'x'}])
+        self.assertTrue(rv.status_code == 409)
+
+        # The new accounts work with both their passwords and their tokens
+        rv, json = admin_client.get('/api/v1/users')
+        self.assertTrue(len(json['users']) == 3)
+        rv, json = TestClient(self.app, 'alex', 'jcole').put('/api/v1/users/' + str(results[1]['id']),
+                                                              data={'username': 'alexander'})
+        self.assertTrue(rv.status_code == 200)
+        rv, json = TestClient(self.app, results[0]['token'], '').post('/api/v1/categories',
+                                                                      data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+
+        # Only the admin may provision users
+        rv, json = TestClient(self.app, 'patrick', 'backend').post('/api/v1/users/bulk', data=rows)
+        self.assertTrue(rv.status_code == 401)
+        self.assertRaises(ValidationError, admin_client.post, '/api/v1/users/bulk', data={'username': 'x'})
+
+    def testBatchItems(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Hits the ball'})
+        self.assertTrue(rv.status_code == 201)
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id))
+        self.assertTrue(len(json['items']) == 1)
+
+        entries = [{'title': 'Glove', 'description': 'Catches the ball'},
+                   {'title': 'Bat', 'description': 'Taken already'},
+                   {'title': 'Helmet', 'description': 'Protects the batter'},
+                   {'title': 'Glove', 'description': 'Repeated in the batch'},
+                   {'title': 'Cap'},
+                   'Base',
+                   {'title': None, 'description': 'No title'},
+                   {'title': ['Bat'], 'description': 'Not a string'},
+                   {'title': 'Mitt', 'description': 42},
+                   {'title': 'Cleats', 'description': None}]
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch', data=entries)
+        self.assertTrue(rv.status_code == 201)
+        results = json['items']
+        self.assertTrue(['error' in result for result in results] ==
+                        [False, True, False, True, True, True, True, True, True, False])
+        self.assertTrue(results[6]['error'] == 'Invalid item: title must be a non-empty string')
+        self.assertTrue(results[7]['error'] == 'Invalid item: title must be a non-empty string')
+        self.assertTrue(results[8]['error'] == 'Invalid item: description must be a string')
+        self.assertTrue(results[0]['title'] == 'Glove' and results[0]['category'] == cat_id)
+        rv, json = self.client.get('/api/v1/items/' + str(results[2]['id']))
+        self.assertTrue(json['title'] == 'Helmet')
+
+        # The cached category sees the new items
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id))
+        self.assertTrue(len(json['items']) == 4)
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id) + '/items')
+        self.assertTrue(len(json['Baseball items']) == 4)
+
+        # Nothing valid, nothing created
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch',
+                                    data=[{'title': 'Bat', 'description': 'Again'}])
+        self.assertTrue(rv.status_code == 400)
+        self.assertRaises(NotFound, self.client.post, '/api/v1/categories/1234/items/batch', data=entries)
+        self.assertRaises(ValidationError, self.client.post,
+                          '/api/v1/categories/' + str(cat_id) + '/items/batch', data={'title': 'Bat'})
+
+    def testBulkItems(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Soccer'})
+        other_id = int(json['id'])
+        entries = [{'title': title, 'description': title} for title in ['Bat', 'Glove', 'Helmet', 'Cap']]
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch', data=entries)
+        self.assertTrue(rv.status_code == 201)
+        ids = [result['id'] for result in json['items']]
+        rv, json = self.client.get('/api/v1/categories/' + str(other_id))
+        self.assertTrue(json['items'] == [])
+
+        # Move everything from one category to the other
+        rv, json = self.client.put('/api/v1/items?category=' + str(cat_id), data={'category': other_id})
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['count'] == 4)
+        rv, json = self.client.get('/api/v1/categories/' + str(other_id) + '/items')
+        self.assertTrue(len(json['Soccer items']) == 4)
+        rv, json = self.client.get('/api/v1/categories/' + str(other_id))
+        self.assertTrue(sorted(json['items']) == sorted(ids))
+        rv, json = self.client.get('/api/v1/items/' + str(ids[0]))
+        self.assertTrue(json['category'] == other_id)
+
+        # Change a few descriptions, then delete by id and by category
+        rv, json = self.client.put('/api/v1/items?ids=' + ','.join(str(id) for id in ids[:2]),
+                                   data={'description': 'Sold out'})
+        self.assertTrue(json['count'] == 2)
+        rv, json = self.client.get('/api/v1/items/' + str(ids[1]))
+        self.assertTrue(json['description'] == 'Sold out')
+        rv, json = self.client.delete('/api/v1/items?ids=' + str(ids[0]) + ',1234')
+        self.assertTrue(json['count'] == 1)
+        self.assertRaises(NotFound, self.client.get, '/api/v1/items/' + str(ids[0]))
+        rv, json = self.client.delete('/api/v1/items?category=' + str(other_id))
+        self.assertTrue(json['count'] == 3)
+        rv, json = self.client.get('/api/v1/items')
+        self.assertTrue(len(json['items']) == 0)
+        rv, json = self.client.get('/api/v1/categories/' + str(other_id))
+        self.assertTrue(json['items'] == [])
+
+        # A filter is always required
+        self.assertRaises(ValidationError, self.client.delete, '/api/v1/items')
+        self.assertRaises(ValidationError, self.client.put, '/api/v1/items?ids=1', data={'title': 'Bat'})
+        self.assertRaises(ValidationError, self.client.put, '/api/v1/items?ids=1', data={'category': 1234})
+        self.assertRaises(ValidationError, self.client.put, '/api/v1/items?ids=1', data={'category': None})
+        self.assertRaises(ValidationError, self.client.put, '/api/v1/items?ids=1', data={'category': True})
+        self.assertRaises(ValidationError, self.client.put, '/api/v1/items?ids=1', data={'description': ['x']})
+
+    def checkSearch(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Wooden bat that hits the ball'})
+        bat_id = int(json['id'])
+        entries = [{'title': 'Glove', 'description': 'Catches the ball'},
+                   {'title': 'Ball', 'description': 'Thrown by the pitcher'},
+                   {'title': 'Helmet', 'description': 'Protects the batter from a pitch'}]
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch', data=entries)
+        glove_id, ball_id, helmet_id = [result['id'] for result in json['items']]
+
+        # Title matches rank above description matches
+        rv, json = self.client.get('/api/v1/items/search?q=ball')
+        self.assertTrue(rv.status_code == 200)
+        ids = [item['id'] for item in json['items']]
+        self.assertTrue(ids[0] == ball_id)
+        self.assertTrue(sorted(ids) == sorted([bat_id, glove_id, ball_id]))
+        rv, json = self.client.get('/api/v1/items/search?q=wooden+BALL')
+        self.assertTrue([item['id'] for item in json['items']] == [bat_id])
+
+        # Results are paginated
+        rv, json = self.client.get('/api/v1/items/search?q=ball&limit=2')
+        self.assertTrue(len(json['items']) == 2)
+        rv, json = self.client.get(json['next'])
+        self.assertTrue(len(json['items']) == 1 and json['next'] is None)
+
+        # Edits, deletes and bulk writes update the index
+        rv, json = self.client.put('/api/v1/items/' + str(glove_id), data={'description': 'Worn by fielders'})
+        rv, json = self.client.get('/api/v1/items/search?q=fielders')
+        self.assertTrue([item['id'] for item in json['items']] == [glove_id])
+        rv, json = self.client.delete('/api/v1/items/' + str(bat_id))
+        rv, json = self.client.put('/api/v1/items?ids=' + str(helmet_id), data={'description': 'Worn by the batter'})
+        rv, json = self.client.get('/api/v1/items/search?q=ball')
+        self.assertTrue([item['id'] for item in json['items']] == [ball_id])
+        rv, json = self.client.get('/api/v1/items/search?q=worn')
+        self.assertTrue(sorted(item['id'] for item in json['items']) == sorted([glove_id, helmet_id]))
+        rv, json = self.client.get('/api/v1/items/search?q=bat')
+        self.assertTrue(json['items'] == [])
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items/search?q=')
+
+    def testSearch(self):
+        self.assertTrue(isinstance(get_index(), FTS5Index))
+        self.checkSearch()
+
+    def testSearchInMemory(self):
+        self.app.config['CATALOG_SEARCH_BACKEND'] = 'memory'
+        self.checkSearch()
+        self.assertTrue(isinstance(get_index(), MemoryIndex))
+
+        # Items written by other processes are found once they bump the version
+        rv, json = self.client.get('/api/v1/items/search?q=worn')
+        glove_id, helmet_id = sorted(item['id'] for item in json['items'])
+        items, versions = Item.__table__, Version.__table__
+        db.session.execute(items.update().where(items.c.id == glove_id).values(description='Leather'))
+        db.session.execute(Change.__table__.insert().values(entity='items', entity_id=glove_id, deleted=False,
+                                                            created=datetime.utcnow()))
+        db.session.execute(versions.update().where(versions.c.key == 'items')
+                           .values(version=versions.c.version + 1))
+        db.session.commit()
+        rv, json = self.client.get('/api/v1/items/search?q=worn')
+        self.assertTrue([item['id'] for item in json['items']] == [helmet_id])
+        rv, json = self.client.get('/api/v1/items/search?q=leather')
+        self.assertTrue([item['id'] for item in json['items']] == [glove_id])
+
+    def testItemCounts(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Soccer'})
+        other_id = int(json['id'])
+        rv, json = self.client.get('/api/v1/categories/stats')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue([c['item_count'] for c in json['categories']] == [0, 0])
+
+        def counts():
+            rv, json = self.client.get('/api/v1/categories/stats')
+            self.assertTrue(json['total'] == sum(c['item_count'] for c in json['categories']))
+            return [c['item_count'] for c in json['categories']]
+
+        # Every write path keeps the counts in step
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Hits the ball'})
+        item_id = int(json['id'])
+        self.assertTrue(counts() == [1, 0])
+        entries = [{'title': title, 'description': title} for title in ['Glove', 'Helmet', 'Cap']]
+        rv, json = self.client.post('/api/v1/categories/' + str(other_id) + '/items/batch', data=entries)
+        self.assertTrue(counts() == [1, 3])
+        rv, json = self.client.put('/api/v1/items/' + str(item_id), data={'category': other_id})
+        self.assertTrue(counts() == [0, 4])
+        rv, json = self.client.put('/api/v1/items/' + str(item_id), data={'title': 'Baseball Bat'})
+        self.assertTrue(counts() == [0, 4])
+        rv, json = self.client.put('/api/v1/items?ids=' + str(item_id) + ',' + str(item_id + 1),
+                                   data={'category': cat_id})
+        self.assertTrue(counts() == [2, 2])
+        rv, json = self.client.delete('/api/v1/items/' + str(item_id))
+        self.assertTrue(counts() == [1, 2])
+        rv, json = self.client.delete('/api/v1/items?category=' + str(other_id))
+        self.assertTrue(counts() == [1, 0])
+
+        # The category list can carry counts instead of item ids
+        rv, json = self.client.get('/api/v1/categories?with_counts=1')
+        self.assertTrue(json['categories'][0] == {'id': cat_id, 'name': 'Baseball', 'item_count': 1})
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id))
+        self.assertTrue(json['item_count'] == 1)
+
+        # Counts can be rebuilt from scratch
+        db.session.execute(Category.__table__.update().values(item_count=7))
+        db.session.commit()
+        recount()
+        self.assertTrue(counts() == [1, 0])
+
+    def testEmbeddedItems(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def embedded(url):
+            del statements[:]
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                rv, json = self.client.get(url)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertTrue(rv.status_code == 200)
+            return json, len(statements)
+
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        entries = [{'title': title, 'description': title} for title in ['Bat', 'Glove', 'Helmet']]
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch', data=entries)
+        json, queries = embedded('/api/v1/categories?embed=items')
+        self.assertTrue([item['title'] for item in json['categories'][0]['items']] == ['Bat', 'Glove', 'Helmet'])
+
+        # More categories cost no more queries
+        for name in ['Soccer', 'Hockey', 'Tennis']:
+            rv, json = self.client.post('/api/v1/categories', data={'name': name})
+            rv, json = self.client.post('/api/v1/categories/' + str(json['id']) + '/items/batch',
+                                        data=[{'title': name + ' ball', 'description': 'Round'},
+                                              {'title': name + ' shoes', 'description': 'Worn'}])
+        json, more_queries = embedded('/api/v1/categories?embed=items')
+        self.assertTrue(more_queries == queries)
+        self.assertTrue([len(category['items']) for category in json['categories']] == [3, 2, 2, 2])
+        self.assertTrue(json['categories'][1]['items'][0]['title'] == 'Soccer ball')
+
+        # Items can be capped per category
+        json, queries = embedded('/api/v1/categories?embed=items&items_limit=1')
+        self.assertTrue([len(category['items']) for category in json['categories']] == [1, 1, 1, 1])
+        self.assertTrue(json['categories'][0]['item_count'] == 3)
+        # without window functions, which MySQL 5.7 lacks
+        self.assertFalse([statement for statement in statements if 'OVER' in statement.upper()])
+        json, queries = embedded('/api/v1/categories/' + str(cat_id) + '?embed=items&items_limit=2')
+        self.assertTrue([item['title'] for item in json['items']] == ['Bat', 'Glove'])
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/categories?embed=users')
+
+        # Sparse fieldsets may leave out the id
+        json, queries = embedded('/api/v1/categories/' + str(cat_id) + '?embed=items&fields=name,items')
+        self.assertTrue(sorted(json) == ['items', 'name'] and len(json['items']) == 3)
+        json, queries = embedded('/api/v1/categories?embed=items&fields=name,items')
+        self.assertTrue([len(category['items']) for category in json['categories']] == [3, 2, 2, 2])
+        self.assertTrue('id' not in json['categories'][0])
+
+    def testFields(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Hits the ball'})
+        item_id = int(json['id'])
+
+        # Only the requested fields are selected and returned
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rv, json = self.client.get('/api/v1/items?fields=id,title')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertTrue(json['items'] == [{'id': item_id, 'title': 'Bat'}])
+        self.assertTrue(not any('items.description' in statement for statement in statements))
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id) + '/items?fields=title&stream=1')
+        self.assertTrue(loads(rv.data.decode('utf-8')) == {'title': 'Bat'})
+        rv, json = self.client.get('/api/v1/items/search?q=ball&fields=description')
+        self.assertTrue(json['items'] == [{'description': 'Hits the ball'}])
+        rv, json = self.client.get('/api/v1/categories?fields=name,items')
+        self.assertTrue(json['categories'] == [{'name': 'Baseball', 'items': [item_id]}])
+        rv, json = self.client.get('/api/v1/categories?with_counts=1&fields=item_count')
+        self.assertTrue(json['categories'] == [{'item_count': 1}])
+        rv, json = self.client.get('/api/v1/users?fields=username')
+        self.assertTrue(json['users'] == [{'username': self.default_username}])
+
+        # Single resources are projected from the cached representation
+        rv, json = self.client.get('/api/v1/items/' + str(item_id))
+        self.assertTrue(json['description'] == 'Hits the ball')
+        rv, json = self.client.get('/api/v1/items/' + str(item_id) + '?fields=category')
+        self.assertTrue(json == {'category': cat_id})
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id) + '?fields=name&embed=items')
+        self.assertTrue(json == {'name': 'Baseball'})
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items?fields=id,secret')
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items?fields=')
+
+    def testCompression(self):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def fetch(url, encoding):
+            del statements[:]
+            event.listen(db.engine, 'before_cursor_execute', record)
+            try:
+                with self.app.test_request_context(url, headers={'Accept-Encoding': encoding}):
+                    rv = self.app.full_dispatch_request()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', record)
+            self.assertTrue(rv.status_code == 200)
+            data = rv.get_data()
+            if rv.headers.get('Content-Encoding') == 'gzip':
+                data = gzip.GzipFile(fileobj=BytesIO(data)).read()
+            return rv, loads(data.decode('utf-8'))
+
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        entries = [{'title': 'Item %d' % i, 'description': 'Used to play baseball'} for i in range(50)]
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch', data=entries)
+
+        # Large responses are compressed when the client accepts it
+        rv, plain = fetch('/api/v1/items', 'identity')
+        self.assertTrue('Content-Encoding' not in rv.headers)
+        self.assertTrue('Accept-Encoding' in rv.headers['Vary'])
+        size = len(rv.get_data())
+        rv, json = fetch('/api/v1/items', 'gzip, deflate')
+        self.assertTrue(rv.headers['Content-Encoding'] == 'gzip')
+        self.assertTrue(json == plain and len(rv.get_data()) < size / 4)
+        etag = rv.headers['ETag']
+        rv, json = fetch('/api/v1/items/' + str(json['items'][0]['id']), 'gzip')
+        self.assertTrue('Content-Encoding' not in rv.headers)
+
+        # Repeated polls are answered from the payload cache
+        rv, json = fetch('/api/v1/items', 'gzip, deflate')
+        self.assertTrue(json == plain and rv.headers['ETag'] == etag)
+        self.assertTrue(len(statements) == 1 and 'versions' in statements[0])
+        rv, json = self.client.put('/api/v1/items/' + str(plain['items'][0]['id']),
+                                   data={'description': 'Changed'})
+        rv, json = fetch('/api/v1/items', 'gzip, deflate')
+        self.assertTrue(json['items'][0]['description'] == 'Changed')
+        self.assertTrue(rv.headers['ETag'] != etag)
+
+    @committed
+    def testGroupCommit(self):
+        self.app.config['CATALOG_GROUP_COMMIT'] = True
+        self.app.config['CATALOG_GROUP_COMMIT_INTERVAL'] = 0.2
+        commits.init_app(self.app)
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        self.assertTrue(rv.status_code == 201)
+        cat_id = int(json['id'])
+
+        def post_all(titles):
+            results = {}
+
+            def post(title):
+                try:
+                    rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                                data={'title': title, 'description': title})
+                    results[title] = json['id']
+                except IntegrityError as e:
+                    results[title] = e
+            threads = [threading.Thread(target=post, args=(title,)) for title in titles]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        # Concurrent creates share transactions and each get their own id
+        batches = commits.batches
+        results = post_all(['Item %d' % i for i in range(8)])
+        self.assertTrue(len(set(results.values())) == 8)
+        self.assertTrue(commits.batches - batches < 8)
+        rv, json = self.client.get('/api/v1/items')
+        self.assertTrue(sorted(item['id'] for item in json['items']) == sorted(results.values()))
+        for item in json['items']:
+            self.assertTrue(results[item['title']] == item['id'])
+
+        # A failing row does not take the rest of its batch down
+        results = post_all(['Item 0', 'Glove', 'Helmet'])
+        self.assertTrue(isinstance(results.pop('Item 0'), IntegrityError))
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id))
+        self.assertTrue(sorted(json['items'])[-2:] == sorted(results.values()))
+        self.assertTrue(json['item_count'] == 10)
+
+        # A batch that cannot even roll back fails its requests, not the flusher
+        def broken(batch):
+            raise RuntimeError('connection lost')
+        commits.commit = broken
+        try:
+            self.assertRaises(RuntimeError, self.client.post, '/api/v1/categories/' + str(cat_id) + '/items',
+                              data={'title': 'Cap', 'description': 'Cap'})
+        finally:
+            del commits.commit
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Cap', 'description': 'Cap'})
+        self.assertTrue(rv.status_code == 201 and json['id'] is not None)
+
+        # A dead flusher is replaced
+        commits.queue.put(None)
+        commits.thread.join(5)
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bag', 'description': 'Bag'})
+        self.assertTrue(rv.status_code == 201 and json['id'] is not None)
+
+        # Requests stop waiting behind a stuck commit and their rows are
+        # dropped, while the requests of the stuck batch get its outcome
+        commit = commits.commit
+        started = threading.Event()
+
+        def stuck(batch):
+            started.set()
+            time.sleep(0.3)
+            commit(batch)
+        commits.commit = stuck
+        commits.size = 1
+        commits.timeout = 0.05
+        try:
+            results = {}
+            thread = threading.Thread(target=lambda: results.update(post_all(['Bench'])))
+            thread.start()
+            self.assertTrue(started.wait(5))
+            self.assertRaises(ServiceUnavailable, self.client.post, '/api/v1/categories/' + str(cat_id) + '/items',
+                              data={'title': 'Stool', 'description': 'Stool'})
+            thread.join(5)
+            self.assertTrue(results.get('Bench') is not None and not isinstance(results['Bench'], Exception))
+        finally:
+            del commits.commit
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Chair', 'description': 'Chair'})
+        self.assertTrue(rv.status_code == 201)
+        rv, json = self.client.get('/api/v1/items')
+        titles = [item['title'] for item in json['items']]
+        self.assertTrue('Bench' in titles and 'Chair' in titles and 'Stool' not in titles)
+
+    def testPoolStats(self):
+        rv, json = self.client.get('/api/v1/_internal/pool')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(json['pool'] == 'TimedNullPool')
+        self.assertTrue(json['checkouts'] > 0 and json['checkouts'] >= json['checkins'])
+        self.assertTrue(json['checkout_latency']['count'] > 0)
+        self.assertTrue(json['checkout_latency']['buckets'][-1] == ['+Inf', json['checkout_latency']['count']])
+
+        # Queue pools also report their size, overflow and waits
+        engine = create_engine('sqlite://', poolclass=timed(QueuePool),
+                               pool_size=1, max_overflow=0, pool_timeout=0.05)
+        timeouts = stats.timeouts
+        conn = engine.connect()
+        self.assertRaises(TimeoutError, engine.connect)
+        self.assertTrue(stats.timeouts == timeouts + 1)
+        report = stats.report(engine.pool)
+        self.assertTrue(report['size'] == 1 and report['overflow'] == 0 and report['checked_out'] == 1)
+        self.assertTrue(report['wait']['sum'] >= 0.05)
+        conn.close()
+        engine.dispose()
+
+    def testMetrics(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        rv, json = self.client.get('/api/v1/items')
+        rv, json = self.client.get('/api/v1/items')
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/items?limit=0')
+        with self.app.test_request_context('/metrics'):
+            rv = self.app.full_dispatch_request()
+        self.assertTrue(rv.status_code == 200 and rv.mimetype == 'text/plain')
+        samples = {}
+        for line in rv.get_data().decode('utf-8').splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+
+        # Requests are counted per endpoint, method and status
+        labels = '{endpoint="api.get_items_all",method="GET",status="200"}'
+        self.assertTrue(samples['catalog_http_requests_total' + labels] == 2)
+        self.assertTrue(samples['catalog_http_request_duration_seconds_count' + labels] == 2)
+        self.assertTrue(samples['catalog_http_request_duration_seconds_bucket'
+                                '{endpoint="api.get_items_all",le="+Inf",method="GET",status="200"}'] == 2)
+        self.assertTrue(samples['catalog_http_response_bytes_total' + labels] > 0)
+        self.assertTrue(samples['catalog_http_sql_statements_total' + labels] >= 3)
+        self.assertTrue(samples['catalog_http_requests_total'
+                                '{endpoint="api.new_category",method="POST",status="201"}'] == 1)
+
+        # Pool and cache statistics are exported alongside
+        self.assertTrue(samples['catalog_db_pool_checkouts_total'] > 0)
+        self.assertTrue('catalog_db_pool_wait_seconds_count' in samples)
+        self.assertTrue('catalog_cache_hits_total{cache="entities"}' in samples)
+
+    @committed
+    def testReplicas(self):
+        uri = self.app.config['SQLALCHEMY_DATABASE_URI']
+        self.app.config['SQLALCHEMY_REPLICA_URIS'] = [uri + '.replica0', uri + '.replica1']
+        replicas.init_app(self.app)
+        for i in range(2):
+            engine = db.get_engine(self.app, 'replica%d' % i)
+            db.metadata.drop_all(engine)
+            db.metadata.create_all(engine)
+            engine.execute(User.__table__.insert(), id=10 + i, username='replica%d' % i,
+                           password_hash='')
+
+        def usernames(headers={}):
+            rv, json = self.client.get('/api/v1/users', headers=headers)
+            return [user['username'] for user in json['users']]
+
+        # Reads take turns on the replicas
+        self.assertTrue([usernames() for _ in range(3)] == [['replica0'], ['replica1'], ['replica0']])
+
+        # Writes go to the primary, which the writer then reads from for a while
+        rv, json = self.client.post('/api/v1/users', data={'username': 'patrick', 'password': 'backend'})
+        self.assertTrue(rv.status_code == 201)
+        cookie = rv.headers['Set-Cookie'].split(';')[0]
+        self.assertTrue(usernames({'Cookie': cookie}) == ['Admin', 'patrick'])
+        self.assertTrue(usernames() == ['replica1'])
+
+        # Rows read from a lagging replica are not cached for the writer
+        url = '/api/v1/users/' + str(json['id'])
+        self.assertRaises(NotFound, self.client.get, url)
+        rv, user = self.client.get(url, headers={'Cookie': cookie})
+        self.assertTrue(rv.status_code == 200 and user['username'] == 'patrick')
+
+        # Once a request writes, it stays on the primary
+        with self.app.test_request_context('/api/v1/users'):
+            g.replica = db.get_engine(self.app, 'replica0')
+            self.assertTrue(User.query.get(10).username == 'replica0')
+            db.session.add(User(username='tom', password_hash=''))
+            db.session.flush()
+            self.assertTrue(g.replica is None)
+            self.assertTrue(User.query.filter_by(username='tom').count() == 1)
+            db.session.rollback()
+
+        # The least busy replica is preferred
+        self.app.config['CATALOG_REPLICA_SELECTION'] = 'least-busy'
+        replicas.init_app(self.app)
+        with self.app.test_request_context('/api/v1/users'):
+            first, second = replicas.acquire(), replicas.acquire()
+            replicas.release(second)
+            self.assertTrue(replicas.acquire() == second)
+
+    def testPrefork(self):
+        # run.py in a directory of its own, with its own database
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.mkdir(os.path.join(directory, 'config'))
+        with open(os.path.join(directory, 'config', 'prefork.py'), 'w') as f:
+            f.write("SECRET_KEY = 'top-secret!'\n"
+                    "SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n" % os.path.join(directory, 'catalog.sqlite'))
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        bind = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        run = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run.py')
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        master = subprocess.Popen([sys.executable, run, '--mode', 'prefork', '--bind', bind,
+                                   '--workers', '2', '--keepalive', '0', '--graceful-timeout', '5'],
+                                  cwd=directory, env=dict(os.environ, FLASK_CONFIG='prefork'),
+                                  stdout=devnull, stderr=devnull)
+
+        def kill():
+            if master.poll() is None:
+                master.kill()
+                master.wait()
+        self.addCleanup(kill)
+
+        def workers():
+            # ps fails when there is none
+            output = subprocess.Popen(['ps', '-o', 'pid=', '--ppid', str(master.pid)],
+                                      stdout=subprocess.PIPE).communicate()[0]
+            return set(int(pid) for pid in output.split())
+
+        def wait_for(condition):
+            deadline = time.time() + 20
+            while not condition():
+                self.assertTrue(time.time() < deadline and master.poll() is None)
+                time.sleep(0.05)
+
+        def serves():
+            try:
+                rv = urlopen('http://' + bind + '/api/v1/categories', timeout=5)
+            except IOError:
+                return False
+            return rv.getcode() == 200 and loads(rv.read().decode('utf-8'))['categories'] == []
+
+        # The master forks its workers, which serve the shared socket
+        wait_for(serves)
+        wait_for(lambda: len(workers()) == 2)
+        first = workers()
+
+        # SIGHUP replaces every worker
+        master.send_signal(signal.SIGHUP)
+        wait_for(lambda: len(workers()) == 2 and not workers() & first)
+        self.assertTrue(serves())
+        second = workers()
+
+        # SIGTERM retires the workers and the master exits cleanly
+        master.send_signal(signal.SIGTERM)
+        deadline = time.time() + 20
+        while master.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertTrue(master.returncode == 0)
+        self.assertTrue(not any(imports.alive(pid) for pid in second))
+
+    def testChanges(self):
+        def changes(since=None, limit=None):
+            url = '/api/v1/changes?'
+            if since is not None:
+                url += 'since=' + since + '&'
+            if limit is not None:
+                url += 'limit=' + str(limit)
+            rv, json = self.client.get(url)
+            self.assertTrue(rv.status_code == 200)
+            return [(change['type'], change['entity'], change['id']) for change in json['changes']], json
+
+        rv, json = changes()
+        self.assertTrue(rv == [] and json['next'] is None)
+        start = json['cursor']
+
+        # Creates, edits and deletes are logged in order
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items',
+                                    data={'title': 'Bat', 'description': 'Wooden'})
+        bat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch',
+                                    data=[{'title': 'Glove', 'description': 'Leather'},
+                                          {'title': 'Helmet', 'description': 'Hard'}])
+        glove_id, helmet_id = [result['id'] for result in json['items']]
+        rv, json = changes(start)
+        self.assertTrue(rv == [('upsert', 'categories', cat_id), ('upsert', 'items', bat_id),
+                               ('upsert', 'items', glove_id), ('upsert', 'items', helmet_id)])
+        self.assertTrue(json['changes'][0]['data'] == {'id': cat_id, 'name': 'Baseball', 'item_count': 3})
+        self.assertTrue(json['changes'][1]['data']['title'] == 'Bat')
+
+        # A mirror only fetches what changed since its cursor
+        cursor = json['cursor']
+        rv, json = self.client.put('/api/v1/items/' + str(bat_id), data={'description': 'Aluminium'})
+        rv, json = self.client.delete('/api/v1/items?ids=' + str(glove_id))
+        rv, json = changes(cursor)
+        self.assertTrue(rv == [('upsert', 'items', bat_id), ('upsert', 'categories', cat_id),
+                               ('delete', 'items', glove_id)])
+        self.assertTrue(json['changes'][0]['data']['description'] == 'Aluminium')
+        self.assertTrue(json['changes'][1]['data']['item_count'] == 2)
+        cursor = json['cursor']
+        rv, json = changes(cursor)
+        self.assertTrue(rv == [] and json['cursor'] == cursor)
+
+        # Deleted rows only leave their tombstone
+        rv, json = self.client.delete('/api/v1/items/' + str(helmet_id))
+        rv, json = changes(start)
+        self.assertTrue(rv == [('upsert', 'categories', cat_id), ('upsert', 'items', bat_id),
+                               ('delete', 'items', glove_id), ('delete', 'items', helmet_id)])
+
+        # Pages follow each other
+        rv, json = changes(start, limit=3)
+        self.assertTrue(rv == [('upsert', 'categories', cat_id), ('upsert', 'items', bat_id)])
+        rv, json = self.client.get(json['next'])
+        self.assertTrue([(change['entity'], change['id']) for change in json['changes']] ==
+                        [('categories', cat_id)])
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/changes?since=nonsense')
+
+        # Writers sharing no other version key still take the changes lock
+        # before their change ids and hold it until they commit
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            rv, json = self.client.post('/api/v1/categories', data={'name': 'Soccer'})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        writes = [(statement.split()[0], 'changes' in str(parameters)) for statement, parameters in statements
+                  if statement.startswith(('INSERT', 'UPDATE'))]
+        self.assertTrue(writes[-2:] == [('UPDATE', True), ('INSERT', False)])
+        self.assertTrue('INTO changes' in [statement for statement, parameters in statements
+                                           if statement.startswith('INSERT')][-1])
+
+    def testExport(self):
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Soccer'})
+        entries = [{'title': title, 'description': title + u' \u00e9'} for title in ['Bat', 'Glove', 'Helmet']]
+        rv, json = self.client.post('/api/v1/categories/' + str(cat_id) + '/items/batch', data=entries)
+        ids = [result['id'] for result in json['items']]
+
+        # Categories then items, read a couple of rows at a time
+        self.app.config['CATALOG_STREAM_BATCH'] = 2
+        client = self.app.test_client()
+        rv = client.get('/api/v1/export')
+        self.assertTrue(rv.status_code == 200)
+        self.assertTrue(rv.mimetype == 'application/x-ndjson')
+        rows = [loads(line) for line in rv.data.decode('utf-8').splitlines()]
+        self.assertTrue([(row['entity'], row['id']) for row in rows] ==
+                        [('categories', cat_id), ('categories', cat_id + 1)] +
+                        [('items', id) for id in ids])
+        self.assertTrue(rows[0]['item_count'] == 3)
+        self.assertTrue(rows[2] == {'entity': 'items', 'id': ids[0], 'category': cat_id,
+                                    'title': 'Bat', 'description': u'Bat \u00e9'})
+
+        # CSV, gzipped on the fly
+        rv = client.get('/api/v1/export?format=csv&gzip=1')
+        self.assertTrue(rv.mimetype == 'application/gzip')
+        self.assertTrue('catalog.csv.gz' in rv.headers['Content-Disposition'])
+        lines = gzip.GzipFile(fileobj=BytesIO(rv.data)).read().decode('utf-8').splitlines()
+        self.assertTrue(lines[0] == 'entity,id,name,item_count,category,title,description')
+        self.assertTrue(lines[1] == 'categories,%d,Baseball,3,,,' % cat_id)
+        self.assertTrue(lines[-1] == u'items,%d,,,%d,Helmet,Helmet \u00e9' % (ids[2], cat_id))
+
+        # An export resumes after the last row received
+        rv = client.get('/api/v1/export?entity=items&after=items:' + str(ids[0]))
+        self.assertTrue([loads(line)['id'] for line in rv.data.decode('utf-8').splitlines()] == ids[1:])
+        rv = client.get('/api/v1/export?after=categories:' + str(cat_id))
+        self.assertTrue(len(rv.data.decode('utf-8').splitlines()) == 4)
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/export?format=xml')
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/export?after=42')
+        self.assertRaises(ValidationError, self.client.get, '/api/v1/export?entity=users')
+
+    @committed
+    def testImports(self):
+        self.app.config['CATALOG_IMPORT_CHUNK'] = 2
+        importer.init_app(self.app)
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        client = self.app.test_client()
+
+        def upload(body, format):
+            rv = client.post('/api/v1/imports?format=' + format, data=body,
+                             headers={'Authorization': self.client.auth})
+            self.assertTrue(rv.status_code == 202)
+            self.assertTrue(loads(rv.data.decode('utf-8'))['status'] == 'queued')
+            # the job runs in the background, poll until it is over
+            location = rv.headers['Location']
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                db.session.remove()
+                rv, json = self.client.get(location)
+                if json['status'] in ('done', 'failed'):
+                    return json
+                time.sleep(0.01)
+            self.fail('import still running')
+
+        # Valid rows are imported, the others reported by line
+        rows = [{'entity': 'categories', 'name': 'Soccer'},
+                {'title': 'Bat', 'description': 'Wooden', 'category': cat_id},
+                {'title': 'Ball', 'description': 'Round', 'category': cat_id + 1},
+                'not json',
+                {'title': 'Bat', 'description': 'Again', 'category': cat_id},
+                {'title': 'Net', 'category': cat_id + 1},
+                {'title': 'Goal', 'description': 'Big', 'category': 99},
+                {'entity': 'users', 'username': 'patrick'},
+                {'entity': 'categories', 'name': 'Baseball'},
+                {'title': None, 'description': 'No title', 'category': cat_id},
+                {'entity': 'categories', 'name': ['Tennis']},
+                {'title': 'Cap', 'description': 'Blue', 'category': cat_id}]
+        body = '\n'.join(row if isinstance(row, str) else dumps(row) for row in rows) + '\n'
+        json = upload(body, 'ndjson')
+        self.assertTrue(json['status'] == 'done')
+        self.assertTrue(json['rows'] == 12 and json['categories'] == 1 and json['items'] == 3)
+        self.assertTrue(json['progress'] == 1.0 and json['position'] == json['size'] == len(body))
+        self.assertTrue(json['error_count'] == 8)
+        self.assertTrue([error['line'] for error in json['errors']] == [4, 5, 6, 7, 8, 9, 10, 11])
+        self.assertTrue(json['errors'][1]['error'] == 'Conflict: an item titled Bat already exists')
+        self.assertTrue(json['errors'][6]['error'] == 'Invalid item: title must be a non-empty string')
+        self.assertTrue(json['errors'][7]['error'] == 'Invalid category: name must be a non-empty string')
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id + 1))
+        self.assertTrue(json['name'] == 'Soccer' and json['item_count'] == 1)
+
+        # CSV in the layout of the export
+        body = ('entity,id,name,item_count,category,title,description\r\n'
+                'items,,,,%d,Glove,"Leather, brown"\r\n'
+                'items,,,,%d,Helmet,\r\n' % (cat_id, cat_id))
+        json = upload(body, 'csv')
+        self.assertTrue(json['items'] == 2 and json['error_count'] == 0)
+        rv, json = self.client.get('/api/v1/categories/' + str(cat_id) + '/items')
+        self.assertTrue([item['description'] for item in json['Baseball items']] ==
+                        ['Wooden', 'Blue', 'Leather, brown', ''])
+
+        # A job that fails outside of its batches does not stop the workers
+        run_job = imports.run_job
+
+        def broken(job_id, chunk, max_errors):
+            imports.run_job = run_job
+            raise RuntimeError('database went away')
+        imports.run_job = broken
+        json = upload(body, 'csv')
+        self.assertTrue(json['status'] == 'failed' and json['message'] == 'RuntimeError: database went away')
+        json = upload(body.replace('Glove', 'Mitt').replace('Helmet', 'Visor'), 'csv')
+        self.assertTrue(json['status'] == 'done' and json['items'] == 2)
+        self.assertRaises(ValidationError, self.client.post, '/api/v1/imports', data={})
+        rv = client.post('/api/v1/imports?format=csv', data=body)
+        self.assertTrue(rv.status_code == 401)
+
+        # The jobs of a process that died are requeued or failed
+        process = subprocess.Popen([sys.executable, '-c', ''])
+        process.wait()
+        jobs = {}
+        for status, owner in (('queued', process.pid), ('running', process.pid), ('queued', os.getpid())):
+            path = os.path.join(importer.directory, '%s-%d.csv' % (status, owner))
+            with open(path, 'w') as f:
+                f.write(body.replace('Glove', 'Mitt ' + status).replace('Helmet', 'Visor ' + status))
+            job = imports.ImportJob(format='csv', path=path, size=len(body), status=status, owner=owner)
+            db.session.add(job)
+            db.session.commit()
+            jobs[status, owner] = (job.id, path)
+        importer.recover()
+        deadline = time.time() + 10
+        while imports.ImportJob.query.get(jobs['queued', process.pid][0]).status != 'done':
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.01)
+            db.session.remove()
+        job_id, path = jobs['running', process.pid]
+        job = imports.ImportJob.query.get(job_id)
+        self.assertTrue(job.status == 'failed' and job.message.startswith('Interrupted'))
+        self.assertTrue(not os.path.exists(path))
+        job_id, path = jobs['queued', os.getpid()]
+        self.assertTrue(imports.ImportJob.query.get(job_id).status == 'queued' and os.path.exists(path))
+        os.remove(path)
+
+    @committed
+    def testSnapshots(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config.update(CATALOG_SNAPSHOT=True, CATALOG_SNAPSHOT_DIR=directory,
+                               CATALOG_SNAPSHOT_DELAY=0.05)
+        snapshots.init_app(self.app)
+        # cleanups run last in first out, so the builder stops first
+        self.addCleanup(snapshots.stop)
+        rv, json = self.client.post('/api/v1/categories', data={'name': 'Baseball'})
+        cat_id = int(json['id'])
+        self.client.post('/api/v1/categories/' + str(cat_id) + '/items', data={'title': 'Bat', 'description': 'Wooden'})
+        client = self.app.test_client()
+
+        def built(*names):
+            deadline = time.time() + 10
+            while time.time() < deadline:
+                if all(snapshots.manifest(name) for name in names):
+                    return
+                time.sleep(0.01)
+            self.fail('snapshots not built')
+
+        # The first request is answered live and has the snapshots built
+        live = client.get('/api/v1/items')
+        built('categories', 'items')
+        rv = client.get('/api/v1/items')
+        self.assertTrue(rv.status_code == 200 and rv.mimetype == 'application/json')
+        self.assertTrue(rv.data == live.data)
+        self.assertTrue(rv.content_length == len(live.data))
+        self.assertTrue(rv.headers['Last-Modified'] == live.headers['Last-Modified'])
+        etag = rv.headers['ETag']
+        rv = client.get('/api/v1/items', headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 304)
+        rv = client.get('/api/v1/categories', headers={'Accept-Encoding': 'gzip'})
+        self.assertTrue(rv.headers['Content-Encoding'] == 'gzip')
+        self.assertTrue(rv.headers['ETag'].endswith('-gzip"'))
+        json = loads(gzip.GzipFile(fileobj=BytesIO(rv.data)).read().decode('utf-8'))
+        self.assertTrue(json['categories'][0]['item_count'] == 1)
+
+        # Requests with arguments still run the view
+        rv = client.get('/api/v1/items?page_size=1', headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200)
+
+        # A write deletes the snapshots it changes, then they are rebuilt
+        self.client.post('/api/v1/categories/' + str(cat_id) + '/items', data={'title': 'Glove', 'description': 'Leather'})
+        self.assertTrue(snapshots.manifest('items') is None)
+        self.assertTrue(snapshots.manifest('categories') is None)
+        client.get('/api/v1/items')
+        built('categories', 'items')
+        rv = client.get('/api/v1/items', headers={'If-None-Match': etag})
+        self.assertTrue(rv.status_code == 200 and rv.headers['ETag'] != etag)
+        self.assertTrue(len(loads(rv.data.decode('utf-8'))['items']) == 2)
+        self.assertTrue(len(os.listdir(directory)) == 6)
+
+        # Writes of processes that do not share the directory are seen too
+        etag = rv.headers['ETag']
+        versions = Version.__table__
+        db.session.execute(versions.update().where(versions.c.key == 'items')
+                           .values(version=versions.c.version + 1))
+        db.session.commit()
+        self.assertTrue(snapshots.manifest('items') is not None)
+        rv = client.get('/api/v1/items')
+        # answered live, with the ETag of the view
+        self.assertTrue(rv.status_code == 200 and rv.headers['ETag'] != etag)
+        deadline = time.time() + 10
+        while rv.headers['ETag'] != etag and time.time() < deadline:
+            time.sleep(0.01)
+            rv = client.get('/api/v1/items')
+        self.assertTrue(rv.headers['ETag'] == etag)
+
     def testUsers(self):
         # Get all users
         rv, json = self.client.get('/api/v1/users')